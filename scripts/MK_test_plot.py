@@ -5,28 +5,24 @@ import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 
-os.makedirs("plots", exist_ok=True)
+from mk_trend import TREND_DECREASING, TREND_INCREASING, TREND_NONE
 
-ds = xr.open_dataset("wd50_mk_trend.nc")
-trend = ds["trend"].sortby("lat").sel(lat=slice(32.54, 42.0), lon=slice(-125.0, -113.05))
+os.makedirs("plots", exist_ok=True)
 
-codes = xr.where(
-    trend.astype(str) == "decreasing", -1,
-    xr.where(trend.astype(str) == "no trend", 0,
-             xr.where(trend.astype(str) == "increasing", 1, np.nan))
-).astype(float)
+# trend holds int8 codes (mk_trend.TREND_*); keep them as integers instead of decoding to float
+ds = xr.open_dataset("wd50_mk_trend.nc", mask_and_scale=False)
+codes = ds["trend"].sortby("lat").sel(lat=slice(32.54, 42.0), lon=slice(-125.0, -113.05))
 
-idx = np.full(codes.shape, 3, dtype=np.uint8)  # 3 = transparent for NaN
-idx[np.isfinite(codes)] = 1  # default to white (none)
-idx[codes == -1] = 0         # red
-idx[codes == 0]  = 1         # white
-idx[codes == 1]  = 2         # blue
+idx = np.full(codes.shape, 3, dtype=np.uint8)  # 3 = transparent for untested cells
+idx[codes.values == TREND_DECREASING] = 0  # red
+idx[codes.values == TREND_NONE] = 1        # white
+idx[codes.values == TREND_INCREASING] = 2  # blue
 
 lut = np.array([
     [255,   0,   0, 255],  # red
     [255, 255, 255, 255],  # white
     [  0,   0, 255, 255],  # blue
-    [  0,   0,   0,   0],  # transparent (NaN)
+    [  0,   0,   0,   0],  # transparent (untested)
 ], dtype=np.uint8)
 
 rgba = lut[idx]  # (lat, lon, 4)
@@ -0,0 +1,45 @@
+"""Exact per-cell wet-day percentiles over a multi-decade base period, out of core.
+
+A 30-year base period is ~11,000 days, far more than fits in memory as a CONUS
+cube. The daily archive is read one spatial tile at a time, aligned to its
+chunks so each chunk is read once, and each tile's full record is sorted to
+give the exact percentile (the same interpolation np.nanpercentile uses on the
+wet days). Tiles without a valid cell are skipped, so the work scales with land
+area. Peak memory is about two tiles' records per worker thread.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from daily_archive import SPACE_CHUNK
+from wd50_metrics import WET_DAY_THRESHOLD_MM, iter_tiles, percentile_from_desc, sorted_wet_desc
+
+BASE_TILE = (SPACE_CHUNK, SPACE_CHUNK)
+
+
+def tile_percentile(block, q, wet_threshold=WET_DAY_THRESHOLD_MM):
+    desc = sorted_wet_desc(block, wet_threshold)
+    return percentile_from_desc(desc, np.count_nonzero(desc, axis=0), q)
+
+
+def archive_percentile(archive, first_date, n_days, q, wet_threshold=WET_DAY_THRESHOLD_MM,
+                       tile=BASE_TILE, workers=1):
+    # (lat, lon) float32 map of each cell's q-th percentile of wet days over the n_days from first_date;
+    # NaN where a cell has no wet days in the period
+    cells = archive.cell_index()
+    valid = cells.scatter(np.ones(cells.n_cells, dtype=bool), fill=False)
+    out = np.full(cells.grid_shape, np.nan, dtype=np.float32)
+
+    def run(tile_slices):
+        rows, cols = tile_slices
+        block = archive.read_days(first_date, n_days, rows=rows, cols=cols)
+        out[rows, cols] = tile_percentile(block, q, wet_threshold)
+
+    tiles = [(rows, cols) for rows, cols in iter_tiles(*cells.grid_shape, tile) if valid[rows, cols].any()]
+    if workers == 1:
+        for tile_slices in tiles:
+            run(tile_slices)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(run, tiles))
+    return out
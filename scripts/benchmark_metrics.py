@@ -0,0 +1,59 @@
+# Times the fused single-sort metric engine against the NumPy sequence wd50_dynamic_6.py used to run
+import time
+import warnings
+import numpy as np
+
+from metric_registry import compute_metrics
+from wd50_metrics import WET_DAY_THRESHOLD_MM, calculate_wd50, synthetic_cube
+
+SHAPES = [(365, 100, 100), (365, 237, 287)]  # small test box, California at 4 km
+REPEATS = 3
+
+
+def legacy_metrics(full_data):
+    wd50_map = np.apply_along_axis(calculate_wd50, 0, full_data)
+    prcptot_map = np.nansum(full_data, axis=0)
+    r95_threshold = np.nanpercentile(full_data, 95, axis=0)
+    r95_mask = full_data > r95_threshold
+    r95p_map = np.sum(r95_mask & ~np.isnan(full_data), axis=0)
+    r95ptot_map = np.sum(np.where(r95_mask, full_data, 0), axis=0)
+    r95ptot_frac_map = np.where(prcptot_map > 0, r95ptot_map / prcptot_map, np.nan)
+    return {
+        "wd50": wd50_map,
+        "prcptot": prcptot_map,
+        "r95p": r95p_map,
+        "r95ptot": r95ptot_map,
+        "r95ptot_frac": r95ptot_frac_map,
+    }
+
+
+def best_time(func, cube):
+    times = []
+    for _ in range(REPEATS):
+        t0 = time.perf_counter()
+        result = func(cube)
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    warnings.simplefilter("ignore", RuntimeWarning)
+    for shape in SHAPES:
+        cube = synthetic_cube(shape)
+        cube[cube < WET_DAY_THRESHOLD_MM] = np.nan  # the legacy sequence expects wet days only
+        t_legacy, legacy = best_time(legacy_metrics, cube)
+        t_fused, fused = best_time(compute_metrics, cube)
+
+        for name in legacy:
+            exact = name in ("wd50", "r95p")
+            same = (np.array_equal(legacy[name], fused[name], equal_nan=True) if exact
+                    else np.allclose(legacy[name], fused[name], rtol=1e-5, equal_nan=True))
+            if not same:
+                raise AssertionError(f"{name} differs from the legacy NumPy sequence for {shape}")
+
+        print(f"{shape}: legacy {t_legacy:.2f}s | fused {t_fused:.2f}s | speedup {t_legacy / t_fused:.1f}x")
+
+        # Storm WD50 should stay within a small factor of the daily kernel
+        t_daily, _ = best_time(lambda c: compute_metrics(c, ("wd50",)), cube)
+        t_event, _ = best_time(lambda c: compute_metrics(c, ("event_wd50",)), cube)
+        print(f"{shape}: daily wd50 {t_daily:.2f}s | event wd50 {t_event:.2f}s | ratio {t_event / t_daily:.1f}x")
@@ -0,0 +1,111 @@
+"""Per-day checkpoints for an in-progress water year.
+
+The daily cube is a memory-mapped .npy scratch file with one row per day of
+the water year (days PRISM did not have stay at the fill value) and one
+column per valid cell (see valid_cells.py); the cell index is saved beside it.
+A small JSON sidecar records how far ingest got, each day's status, the grid,
+and the config hash the cube was built with, so a restarted run reopens the
+cube and continues from the day after the last one decoded instead of from
+October 1. Run this file directly to check save, resume and invalidation.
+"""
+import json
+import os
+
+import numpy as np
+
+from valid_cells import CellIndex
+
+
+class YearCheckpoint:
+    def __init__(self, directory, wy, config_hash, n_days):
+        self.wy = wy
+        self.config_hash = config_hash
+        self.n_days = n_days
+        os.makedirs(directory, exist_ok=True)
+        self.cube_path = os.path.join(directory, f"wy{wy}.cube.npy")
+        self.cells_path = os.path.join(directory, f"wy{wy}.cells.npy")
+        self.state_path = os.path.join(directory, f"wy{wy}.json")
+        self.state = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # A checkpoint built with other settings or code is useless; start the year over
+        if (state.get("config_hash") != self.config_hash or not os.path.exists(self.cube_path)
+                or not os.path.exists(self.cells_path)):
+            return None
+        return state
+
+    @property
+    def next_day(self):
+        # Index within the water year of the first day still to ingest
+        return self.state["next_day"] if self.state else 0
+
+    def open_cube(self):
+        # Reopen the scratch cube of a resumed year; returns (cube, cell index, day status)
+        cube = np.lib.format.open_memmap(self.cube_path, mode="r+")
+        cells = CellIndex(self.state["lat"], self.state["lon"], np.load(self.cells_path))
+        status = np.asarray(self.state["status"], dtype=np.int8)
+        return cube, cells, status
+
+    def create_cube(self, cells, dtype=np.float32, fill=np.nan):
+        np.save(self.cells_path, cells.cells)
+        cube = np.lib.format.open_memmap(self.cube_path, mode="w+", dtype=dtype,
+                                         shape=(self.n_days, cells.n_cells))
+        cube[:] = fill
+        self.state = {
+            "config_hash": self.config_hash,
+            "next_day": 0,
+            "status": [0] * self.n_days,
+            "lat": cells.lat.tolist(),
+            "lon": cells.lon.tolist(),
+        }
+        return cube
+
+    def save(self, cube, next_day, status):
+        # Flush the cube before recording progress so the JSON never claims days that aren't on disk
+        cube.flush()
+        self.state["next_day"] = int(next_day)
+        self.state["status"] = np.asarray(status).tolist()
+        tmp_path = f"{self.state_path}.part"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def remove(self):
+        for path in (self.state_path, self.cube_path, self.cells_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.state = None
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    lat, lon = np.linspace(40, 39, 4), np.linspace(-120, -119, 5)
+    cells = CellIndex.from_mask(lat, lon, np.arange(20).reshape(4, 5) % 3 != 0)
+    checkpoint = YearCheckpoint(directory, 2012, "config-a", 10)
+    assert checkpoint.next_day == 0
+    cube = checkpoint.create_cube(cells, dtype=np.uint16, fill=65535)
+    cube[:4] = np.arange(4)[:, None]
+    status = np.array([1, 1, 2, 1] + [0] * 6, dtype=np.int8)
+    checkpoint.save(cube, 4, status)
+    del cube
+
+    # A restarted run with the same config resumes after the last saved day
+    resumed = YearCheckpoint(directory, 2012, "config-a", 10)
+    assert resumed.next_day == 4
+    cube, resumed_cells, resumed_status = resumed.open_cube()
+    assert resumed_cells == cells and np.array_equal(resumed_status, status)
+    assert np.array_equal(cube[:4], np.repeat(np.arange(4), cells.n_cells).reshape(4, -1)) and np.all(cube[4:] == 65535)
+    del cube
+
+    # Another config starts the year over
+    assert YearCheckpoint(directory, 2012, "config-b", 10).next_day == 0
+    resumed.remove()
+    assert YearCheckpoint(directory, 2012, "config-a", 10).next_day == 0 and not os.listdir(directory)
+    print("checkpoint save, resume and config invalidation check out")
@@ -1,16 +1,17 @@
-import re
 from pathlib import Path
 import numpy as np
 import pandas as pd
-import xarray as xr
 import matplotlib.pyplot as plt
 import os
 
+from metrics_store import MetricsStore
+from wd50_metrics import wd50
+
 # -----------------------
 # Config
 # -----------------------
 STATION_CSV = "SEY_single_station_testing.csv"
-PRISM_DIR = Path("nc_output2")
+PRISM_STORE = Path("nc_output2") / "metrics_water_year.zarr"
 SITE_LAT = 37.5
 SITE_LON = -119.633
 WET_DAY_THRESHOLD_MM = 1.0
@@ -27,22 +28,9 @@ def water_year(dt):
     return dt.year + 1 if dt.month >= 10 else dt.year
 
 def compute_wd50_from_series_mm(precip_mm):
-    a = np.asarray(precip_mm, dtype=float)
-    a = a[~np.isnan(a)]
-    a = a[a >= WET_DAY_THRESHOLD_MM]
-    if a.size == 0:
-        return 0
-    a_sorted = np.sort(a)[::-1]
-    total = a_sorted.sum()
-    if total <= 0:
-        return 0
-    cumsum = np.cumsum(a_sorted)
-    idx = np.searchsorted(cumsum, 0.5 * total, side="left")
-    return int(idx + 1)
-
-def extract_year_from_filename(p: Path):
-    m = re.search(r"metrics_wy(\d{4})\.nc$", p.name)
-    return int(m.group(1)) if m else None
+    # Same kernel as the gridded pipeline; a station year with no wet days counts as 0
+    value = wd50(np.asarray(precip_mm, dtype=float), wet_threshold=WET_DAY_THRESHOLD_MM)
+    return 0 if np.isnan(value) else int(value)
 
 # -----------------------
 # 1) Load and compute SEY WD50 by water year
@@ -69,34 +57,17 @@ sey_wd50 = sey_wd50[(sey_wd50["wy"] >= COMPARE_YEARS[0]) & (sey_wd50["wy"] <= CO
 # 2) Read PRISM WD50 at nearest grid cell for each WY
 # -----------------------
 print("Locating nearest PRISM grid cell...")
-nc_files = sorted([p for p in PRISM_DIR.glob("metrics_wy*.nc") if extract_year_from_filename(p) is not None])
-if not nc_files:
-    raise FileNotFoundError(f"No PRISM files found in {PRISM_DIR} matching metrics_wyYYYY.nc")
-
-# Use the first file to lock the nearest grid point coordinates
-with xr.open_dataset(nc_files[0]) as ds0:
-    lat0 = float(ds0["lat"].sel(lat=SITE_LAT, method="nearest"))
-    lon0 = float(ds0["lon"].sel(lon=SITE_LON, method="nearest"))
+if not MetricsStore(PRISM_STORE).exists():
+    raise FileNotFoundError(f"No PRISM metrics store at {PRISM_STORE}")
+ds = MetricsStore(PRISM_STORE).open_dataset()
+lat0 = float(ds["lat"].sel(lat=SITE_LAT, method="nearest"))
+lon0 = float(ds["lon"].sel(lon=SITE_LON, method="nearest"))
 
 print(f"Using PRISM grid point lat={lat0:.3f}, lon={lon0:.3f}")
 
-rows = []
-for p in nc_files:
-    wy = extract_year_from_filename(p)
-    if wy is None:
-        continue
-    if wy < COMPARE_YEARS[0] or wy > COMPARE_YEARS[1]:
-        continue
-    with xr.open_dataset(p) as ds:
-        # wd50 is 2D [lat, lon]
-        val = ds["wd50"].sel(lat=lat0, lon=lon0, method="nearest").values
-        try:
-            wd50_val = float(val)
-        except Exception:
-            wd50_val = np.nan
-    rows.append({"wy": wy, "wd50_prism": wd50_val})
-
-prism_wd50 = pd.DataFrame(rows)
+# One per-cell series read instead of a file per water year
+series = ds["wd50"].sel(lat=lat0, lon=lon0).sel(time=slice(*COMPARE_YEARS))
+prism_wd50 = pd.DataFrame({"wy": series["time"].values.astype(int), "wd50_prism": series.values.astype(float)})
 
 # -----------------------
 # 3) Join and plot
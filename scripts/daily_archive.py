@@ -0,0 +1,278 @@
+"""Persistent (time, lat, lon) archive of raw PRISM daily precipitation.
+
+Every ingested day is written once to a Zarr store and any later metric run
+(new metric, threshold or window) reads the days back from local disk instead
+of downloading and decoding rasters again. The layout is plain xarray-readable
+Zarr:
+
+    time    int32 days since ARCHIVE_EPOCH, one entry per calendar day
+    lat/lon cell centres of the ingested grid
+    ppt     uint16 (time, lat, lon) codes of 0.01 mm (scaled_ppt.py), with CF scale_factor and
+            _FillValue attributes so xarray decodes it to float mm with NaN where PRISM has no data
+    status  int8 (time) per-day provenance, see STATUS_* below
+    cells   int64 (cell) flat (lat, lon) indices of the valid cells (valid_cells.py)
+
+The group's config_hash attribute records the ingest settings (region, pipeline
+version) the days were decoded with; an archive opened with another hash is
+refused rather than extended with days decoded differently.
+
+ppt is chunked (TIME_CHUNK, SPACE_CHUNK, SPACE_CHUNK): a quarter of a year by
+64 x 64 cells, small enough that appending one day rewrites little and large
+enough that a per-cell time series is a few hundred chunk reads for 36 years.
+The time axis always starts at ARCHIVE_EPOCH and grows forward as later days
+are added; days that were never ingested stay at the fill value and their
+chunks are never written to disk, and neither are chunks that lie wholly in
+no-data areas. The pipeline works on packed (time, cell) cubes of uint16 codes:
+write_days scatters them onto the grid and read_cells packs the grid back, a
+quarter-year of chunks at a time. read_days returns decoded float32 mm.
+Writers take an exclusive lock file, so parallel water-year processes can share
+one archive. Run this file directly to check writes, reads and refusals.
+"""
+import fcntl
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import xarray as xr
+import zarr
+
+from scaled_ppt import PPT_DTYPE, PPT_FILL, PPT_SCALE, decode_ppt
+from valid_cells import CellIndex
+
+ARCHIVE_EPOCH = datetime(1981, 1, 1)  # first day of PRISM daily data
+TIME_CHUNK = 92
+SPACE_CHUNK = 64
+
+# Per-day status; 0 means the day has not been ingested yet
+STATUS_MISSING = 0
+STATUS_STABLE = 1
+STATUS_PROVISIONAL = 2
+STATUS_EARLY = 3
+STATUS_NOT_FOUND = -1  # PRISM had no file for the day when it was last fetched
+STATUS_CODES = {"stable": STATUS_STABLE, "provisional": STATUS_PROVISIONAL, "early": STATUS_EARLY}
+
+
+@contextmanager
+def locked(path):
+    # Exclusive lock on a store shared by parallel water-year processes
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def day_index(date):
+    return (date - ARCHIVE_EPOCH).days
+
+
+class DailyArchive:
+    def __init__(self, path, config_hash=None):
+        self.path = path
+        self.config_hash = config_hash
+        if self.exists():
+            self._check_config(self._group())
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, "zarr.json"))
+
+    def _create(self, cells):
+        lat_grid, lon_grid = cells.lat, cells.lon
+        group = zarr.open_group(self.path, mode="w")
+        group.attrs["description"] = "PRISM daily precipitation archive (raw, not wet-day filtered)"
+        if self.config_hash is not None:
+            group.attrs["config_hash"] = self.config_hash
+        group.create_array("time", shape=(0,), chunks=(4096,), dtype="int32", fill_value=0,
+                           dimension_names=["time"],
+                           attributes={"units": f"days since {ARCHIVE_EPOCH:%Y-%m-%d}", "calendar": "proleptic_gregorian"})
+        group.create_array("lat", data=np.asarray(lat_grid, dtype=np.float64), dimension_names=["lat"])
+        group.create_array("lon", data=np.asarray(lon_grid, dtype=np.float64), dimension_names=["lon"])
+        group.create_array("ppt", shape=(0, len(lat_grid), len(lon_grid)),
+                           chunks=(TIME_CHUNK, SPACE_CHUNK, SPACE_CHUNK), dtype=PPT_DTYPE, fill_value=PPT_FILL,
+                           dimension_names=["time", "lat", "lon"],
+                           attributes={"units": "mm", "scale_factor": PPT_SCALE, "add_offset": 0.0,
+                                       "_FillValue": int(PPT_FILL)})
+        group.create_array("status", shape=(0,), chunks=(4096,), dtype="int8", fill_value=STATUS_MISSING,
+                           dimension_names=["time"])
+        group.create_array("cells", data=cells.cells, dimension_names=["cell"])
+        return group
+
+    def _group(self, mode="r"):
+        return zarr.open_group(self.path, mode=mode)
+
+    def _check_config(self, group):
+        stored = group.attrs.get("config_hash")
+        if self.config_hash is not None and stored != self.config_hash:
+            raise ValueError(f"{self.path} was ingested with config {stored}, not {self.config_hash}; "
+                             f"use a separate archive path for these settings")
+
+    def _grow(self, group, end):
+        # Extend the time axis so it covers archive days [0, end)
+        old_end = group["time"].shape[0]
+        if end <= old_end:
+            return
+        n_lat, n_lon = group["ppt"].shape[1:]
+        group["ppt"].resize((end, n_lat, n_lon))
+        group["status"].resize((end,))
+        group["time"].resize((end,))
+        group["time"][old_end:] = np.arange(old_end, end, dtype=np.int32)
+
+    def write_days(self, first_date, cube, status, cells):
+        # Store consecutive days of a packed (day, cell) cube of ppt codes starting at first_date;
+        # days with status STATUS_MISSING are left untouched
+        status = np.asarray(status, dtype=np.int8)
+        with locked(self.path):
+            if self.exists():
+                group = self._group("r+")
+                self._check_config(group)
+                if self._cell_index(group) != cells:
+                    raise ValueError(f"{self.path} holds a different grid; use a separate archive per region")
+            else:
+                group = self._create(cells)
+            offset = day_index(first_date)
+            if offset < 0:
+                raise ValueError(f"{first_date:%Y-%m-%d} is before the archive epoch {ARCHIVE_EPOCH:%Y-%m-%d}")
+            self._grow(group, offset + len(cube))
+
+            written = np.flatnonzero(status != STATUS_MISSING)
+            if written.size == 0:
+                return
+            # Write contiguous runs so each touches its chunks once, scattering a chunk row of days at a time
+            breaks = np.flatnonzero(np.diff(written) != 1) + 1
+            for run in np.split(written, breaks):
+                lo, hi = run[0], run[-1] + 1
+                for a, b in self._time_slabs(offset + lo, offset + hi):
+                    block = cells.scatter(cube[a - offset:b - offset], fill=PPT_DTYPE(PPT_FILL))
+                    group["ppt"][a:b] = block
+                group["status"][offset + lo:offset + hi] = status[lo:hi]
+
+    def status(self, first_date, n_days):
+        # Status of n_days starting at first_date; days outside the archive are STATUS_MISSING
+        out = np.full(n_days, STATUS_MISSING, dtype=np.int8)
+        if not self.exists():
+            return out
+        group = self._group()
+        lo, hi = self._clip(group, first_date, n_days)
+        if lo < hi:
+            offset = day_index(first_date)
+            out[lo:hi] = group["status"][offset + lo:offset + hi]
+        return out
+
+    def covers(self, first_date, n_days):
+        return bool(np.all(self.status(first_date, n_days) != STATUS_MISSING))
+
+    def read_days(self, first_date, n_days, out=None, rows=slice(None), cols=slice(None)):
+        # Decoded float32 mm (n_days, lat, lon) block starting at first_date, optionally only the
+        # rows/cols slices of the grid; NaN for days outside the archive
+        group = self._group()
+        if out is None:
+            n_lat, n_lon = group["ppt"].shape[1:]
+            shape = (len(range(n_lat)[rows]), len(range(n_lon)[cols]))
+            out = np.empty((n_days,) + shape, dtype=np.float32)
+        out[:] = np.nan
+        lo, hi = self._clip(group, first_date, n_days)
+        if lo < hi:
+            offset = day_index(first_date)
+            decode_ppt(group["ppt"][offset + lo:offset + hi, rows, cols], out=out[lo:hi])
+        return out
+
+    def read_cells(self, first_date, n_days, cells, out=None):
+        # Packed (n_days, cell) block of ppt codes starting at first_date; PPT_FILL for days outside the archive
+        group = self._group()
+        if out is None:
+            out = np.empty((n_days, cells.n_cells), dtype=PPT_DTYPE)
+        out[:] = PPT_FILL
+        lo, hi = self._clip(group, first_date, n_days)
+        offset = day_index(first_date)
+        for a, b in self._time_slabs(offset + lo, offset + hi):
+            cells.pack(group["ppt"][a:b], out=out[a - offset:b - offset])
+        return out
+
+    def grid(self):
+        group = self._group()
+        return group["lat"][:], group["lon"][:]
+
+    def cell_index(self):
+        return self._cell_index(self._group())
+
+    @staticmethod
+    def _cell_index(group):
+        return CellIndex(group["lat"][:], group["lon"][:], group["cells"][:])
+
+    @staticmethod
+    def _time_slabs(start, stop):
+        # [a, b) archive-day ranges covering [start, stop), split at TIME_CHUNK boundaries
+        edges = list(range((start // TIME_CHUNK + 1) * TIME_CHUNK, stop, TIME_CHUNK))
+        return list(zip([start] + edges, edges + [stop])) if start < stop else []
+
+    def _clip(self, group, first_date, n_days):
+        # Positions [lo, hi) of the requested block that fall inside the archive
+        start = day_index(first_date)
+        return max(-start, 0), min(group["time"].shape[0] - start, n_days)
+
+    def open_dataset(self):
+        # Lazy xarray view of the whole archive for metric experiments
+        return xr.open_zarr(self.path, consolidated=False, chunks=None)
+
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    from datetime import timedelta
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "archive.zarr")
+    lat, lon = np.linspace(40, 39, 4), np.linspace(-120, -119, 5)
+    cells = CellIndex.from_mask(lat, lon, np.arange(20).reshape(4, 5) % 3 != 0)
+    rng = np.random.default_rng(0)
+
+    def codes(n_days):
+        return rng.integers(0, 5000, size=(n_days, cells.n_cells), dtype=PPT_DTYPE)
+
+    # A block across a TIME_CHUNK boundary, and one across both a chunk and a year boundary whose
+    # status has a gap; days with STATUS_MISSING are not written
+    archive = DailyArchive(path, "config-a")
+    spring, winter = datetime(1981, 3, 30), datetime(1981, 12, 20)
+    assert day_index(spring) < TIME_CHUNK < day_index(spring) + 10
+    spring_cube, winter_cube = codes(10), codes(30)
+    winter_status = np.full(30, STATUS_STABLE, dtype=np.int8)
+    winter_status[5:8] = STATUS_MISSING
+    winter_status[20:] = STATUS_PROVISIONAL
+    archive.write_days(spring, spring_cube, np.full(10, STATUS_STABLE), cells)
+    archive.write_days(winter, winter_cube, winter_status, cells)
+
+    status = archive.status(spring, 300)
+    assert np.all(status[:10] == STATUS_STABLE) and np.all(status[10:day_index(winter) - day_index(spring)] == STATUS_MISSING)
+    assert np.array_equal(archive.status(winter, 40), np.concatenate([winter_status, np.zeros(10, np.int8)]))
+    assert archive.covers(spring, 10) and not archive.covers(winter, 30)
+
+    expected = winter_cube.copy()
+    expected[5:8] = PPT_FILL
+    packed = archive.read_cells(winter - timedelta(days=2), 40, cells)
+    assert np.all(packed[:2] == PPT_FILL) and np.array_equal(packed[2:32], expected) and np.all(packed[32:] == PPT_FILL)
+    assert np.array_equal(archive.read_cells(spring, 10, cells), spring_cube)
+
+    # read_days decodes the same values, on the full grid or a window of it
+    grid = archive.read_days(winter - timedelta(days=2), 40)
+    assert np.array_equal(cells.pack(grid), decode_ppt(packed), equal_nan=True)
+    assert np.all(np.isnan(grid[:, ~np.isin(np.arange(20), cells.cells).reshape(4, 5)]))
+    assert np.array_equal(archive.read_days(winter, 30, rows=slice(1, 3), cols=slice(2, 5)), grid[2:32, 1:3, 2:5],
+                          equal_nan=True)
+
+    # A reopened archive keeps its cells; another grid, another ingest config or a day before the epoch is refused
+    assert DailyArchive(path, "config-a").cell_index() == cells
+    other = CellIndex.from_mask(lat, lon, np.ones((4, 5), dtype=bool))
+    for attempt in (lambda: archive.write_days(winter, codes(1), [STATUS_STABLE], other),
+                    lambda: DailyArchive(path, "config-b"),
+                    lambda: archive.write_days(datetime(1980, 12, 31), codes(1), [STATUS_STABLE], cells)):
+        try:
+            attempt()
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected a ValueError")
+    shutil.rmtree(directory)
+    print("daily archive writes across chunks and years, gaps, packed reads and refusals check out")
@@ -4,40 +4,23 @@ from pathlib import Path
 import random
 import numpy as np
 import pandas as pd
-import xarray as xr
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 
+from grids import to_grid
+from metrics_store import load_metrics
+
 OUTDIR = Path("debug_outputs"); OUTDIR.mkdir(parents=True, exist_ok=True)
 NC_DIR = Path("nc_output2")
+STORE = NC_DIR / "metrics_water_year.zarr"
 CA_BBOX = dict(lat=slice(32.54, 42.0), lon=slice(-125.0, -113.05))
 SEG1 = (1990, 2005)
 SEG2 = (2006, 2024)
 VMIN, VMAX = 2.0, 29.0
 
-def list_year_files(start, end):
-    files = sorted(NC_DIR.glob("metrics_wy*.nc"))
-    sel = [f for f in files if start <= int(f.stem.split("wy")[-1]) <= end]
-    if not sel:
-        raise RuntimeError(f"No NetCDFs found for {start}–{end}.")
-    return sel
-
-def load_stack(files):
-    ds_list = []
-    for f in files:
-        yr = int(f.stem.split("wy")[-1])
-        ds = xr.open_dataset(f).assign_coords(time=yr)
-        # ensure ascending coords
-        da = ds["wd50"]
-        if da.lat[0] > da.lat[-1]: da = da.sortby("lat")
-        if da.lon[0] > da.lon[-1]: da = da.sortby("lon")
-        ds_list.append(ds.assign(wd50=da))
-    combo = xr.concat(ds_list, dim="time")
-    return combo
-
 def segment_median(ds, bbox):
-    da = ds.wd50.sel(**bbox).sortby("lat")
+    da = ds.wd50.sel(**bbox)
     return da.median("time", skipna=True)
 
 def stats_for(da, name):
@@ -57,14 +40,13 @@ def stats_for(da, name):
     )
 
 def statewide_yearly_median(ds, bbox):
-    da = ds.wd50.sel(**bbox).sortby("lat")
+    da = ds.wd50.sel(**bbox)
     return da.median(dim=("lat","lon"), skipna=True).to_series().sort_index()
 
 # 1) Load both segments
-seg1_files = list_year_files(*SEG1)
-seg2_files = list_year_files(*SEG2)
-ds1 = load_stack(seg1_files)
-ds2 = load_stack(seg2_files)
+# load_metrics returns ascending lat/lon and reads wd50 once for both segments
+ds1 = load_metrics(STORE, *SEG1, ["wd50"])
+ds2 = load_metrics(STORE, *SEG2, ["wd50"])
 
 # 2) Report original grid differences
 print("Original grid:")
@@ -80,7 +62,7 @@ print("  seg2 lon:", float(ds2.wd50.lon.min()), "→", float(ds2.wd50.lon.max())
 # 3) Regrid seg2 to seg1 grid (rectilinear) BEFORE slicing to CA
 target_lat = ds1.wd50.lat
 target_lon = ds1.wd50.lon
-ds2_rg = ds2.interp(lat=target_lat, lon=target_lon)  # linear interp
+ds2_rg = to_grid(ds2, target_lat, target_lon)  # index alignment, or cached bilinear weights
 
 print("\nAfter regrid to seg1 grid:")
 print("  seg1 grid:", ds1.wd50.sizes)
@@ -0,0 +1,166 @@
+"""Canonical grids that metric outputs are snapped to, and regridding between grids.
+
+Grids read from different PRISM releases or rasterio versions carry the same
+cell centres up to float noise (1e-10 degrees), which is enough to make xarray
+treat two stores as different grids. Outputs are therefore snapped to a
+registered canonical grid when they are written: coordinates that sit on the
+canonical lattice within SNAP_TOLERANCE of a cell are replaced by the exact
+canonical values, so later comparisons align by index.
+
+to_grid moves a dataset onto another grid. When the grids agree up to float
+noise it is an index selection (no interpolation, integer metrics stay
+integers); otherwise it applies bilinear weights, computed once per pair of
+coordinate vectors and cached for the rest of the process.
+"""
+from collections import namedtuple
+
+import numpy as np
+import xarray as xr
+
+from prism_read import PRISM_CONUS_BOUNDS, PRISM_CONUS_SHAPE
+
+GridDef = namedtuple("GridDef", "name west north res n_lat n_lon")
+
+GRIDS = {
+    "prism_4km": GridDef("prism_4km", PRISM_CONUS_BOUNDS[0], PRISM_CONUS_BOUNDS[3], 1 / 24, *PRISM_CONUS_SHAPE),
+}
+CANONICAL_GRID = "prism_4km"
+SNAP_TOLERANCE = 1e-3  # fraction of a cell
+
+_weights = {}  # (source, target coordinate bytes) -> (lo, hi, w), see axis_weights
+
+
+def grid_coords(grid=CANONICAL_GRID):
+    # Cell-centre (lat north to south, lon west to east) of a registered grid
+    g = GRIDS[grid]
+    lat = g.north - (np.arange(g.n_lat) + 0.5) * g.res
+    lon = g.west + (np.arange(g.n_lon) + 0.5) * g.res
+    return lat, lon
+
+
+def lattice_index(values, origin, step):
+    # Integer positions of values on the lattice origin + (i + 0.5) * step, or None if any is off it
+    position = (np.asarray(values, dtype=np.float64) - origin) / step - 0.5
+    index = np.rint(position)
+    return index.astype(np.int64) if np.all(np.abs(position - index) <= SNAP_TOLERANCE) else None
+
+
+def snap_coords(lat, lon, grid=CANONICAL_GRID):
+    # Exact canonical values for lat/lon that lie on the grid's lattice, or None if they do not
+    g = GRIDS[grid]
+    rows = lattice_index(lat, g.north, -g.res)
+    cols = lattice_index(lon, g.west, g.res)
+    if rows is None or cols is None:
+        return None
+    return g.north - (rows + 0.5) * g.res, g.west + (cols + 0.5) * g.res
+
+
+def covering_coords(lat, lon, grid=CANONICAL_GRID):
+    # Canonical cell centres spanning the extent of lat/lon, in the same directions
+    canon_lat, canon_lon = grid_coords(grid)
+    lat_lo, lat_hi = np.min(lat), np.max(lat)
+    lon_lo, lon_hi = np.min(lon), np.max(lon)
+    new_lat = canon_lat[(canon_lat >= lat_lo) & (canon_lat <= lat_hi)]
+    new_lon = canon_lon[(canon_lon >= lon_lo) & (canon_lon <= lon_hi)]
+    if len(lat) > 1 and lat[0] < lat[-1]:
+        new_lat = new_lat[::-1]
+    if len(lon) > 1 and lon[0] > lon[-1]:
+        new_lon = new_lon[::-1]
+    return new_lat, new_lon
+
+
+def axis_weights(source, target):
+    # Linear interpolation along one axis as (lo, hi, w): out = (1 - w) * x[lo] + w * x[hi].
+    # Targets outside the source get lo = -1. Cached per (source, target) pair.
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    key = (source.tobytes(), target.tobytes())
+    if key not in _weights:
+        if len(source) < 2:
+            raise ValueError("Regridding needs at least two source cells along each axis")
+        order = np.argsort(source)
+        ordered = source[order]
+        right = np.clip(np.searchsorted(ordered, target), 1, len(ordered) - 1)
+        left = right - 1
+        w = (target - ordered[left]) / (ordered[right] - ordered[left])
+        lo, hi = order[left], order[right]
+        hi = np.where(w == 0, lo, hi)  # exact hits never touch (possibly NaN) neighbours
+        outside = (target < ordered[0]) | (target > ordered[-1])
+        _weights[key] = (np.where(outside, -1, lo), hi, w)
+    return _weights[key]
+
+
+def regrid(values, src_lat, src_lon, dst_lat, dst_lon):
+    # Bilinear (..., lat, lon) regrid between rectilinear grids; NaN outside the source or next to NaN
+    values = np.asarray(values, dtype=np.float64)
+    out = values
+    for axis, (src, dst) in ((-2, (src_lat, dst_lat)), (-1, (src_lon, dst_lon))):
+        lo, hi, w = axis_weights(src, dst)
+        shape = [1] * out.ndim
+        shape[axis] = len(w)
+        w = w.reshape(shape)
+        out = (1 - w) * np.take(out, np.maximum(lo, 0), axis=axis) + w * np.take(out, hi, axis=axis)
+        outside = (lo < 0).reshape(shape)
+        out = np.where(outside, np.nan, out)
+    return out
+
+
+def aligned_index(source, target):
+    # Positions of target in source when each target sits within SNAP_TOLERANCE cells of a source value
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    if len(source) < 2:
+        return None
+    step = np.median(np.abs(np.diff(source)))
+    order = np.argsort(source)
+    pos = np.clip(np.searchsorted(source[order], target), 1, len(source) - 1)
+    nearer = np.where(np.abs(source[order][pos - 1] - target) <= np.abs(source[order][pos] - target), pos - 1, pos)
+    index = order[nearer]
+    return index if np.all(np.abs(source[index] - target) <= SNAP_TOLERANCE * step) else None
+
+
+def to_grid(ds, lat, lon):
+    # ds (DataArray or Dataset with lat/lon dims) on the grid lat/lon
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    rows = aligned_index(ds["lat"].values, lat)
+    cols = aligned_index(ds["lon"].values, lon)
+    if rows is not None and cols is not None:
+        return ds.isel(lat=rows, lon=cols).assign_coords(lat=lat, lon=lon)
+    src_lat, src_lon = ds["lat"].values, ds["lon"].values
+    return xr.apply_ufunc(
+        regrid, ds, input_core_dims=[["lat", "lon"]], output_core_dims=[["lat", "lon"]],
+        exclude_dims={"lat", "lon"}, kwargs=dict(src_lat=src_lat, src_lon=src_lon, dst_lat=lat, dst_lon=lon),
+        keep_attrs=True,
+    ).assign_coords(lat=lat, lon=lon)
+
+
+def snap_dataset(ds, grid=CANONICAL_GRID):
+    # ds on the canonical grid: exact canonical coordinates if it is already on the lattice,
+    # otherwise regridded onto the canonical cells covering its extent
+    snapped = snap_coords(ds["lat"].values, ds["lon"].values, grid)
+    if snapped is not None:
+        return ds.assign_coords(lat=snapped[0], lon=snapped[1])
+    print(f"Grid is not on the {grid} lattice; regridding bilinearly onto it")
+    return to_grid(ds, *covering_coords(ds["lat"].values, ds["lon"].values, grid))
+
+
+if __name__ == "__main__":
+    lat, lon = grid_coords()
+    noisy_lat, noisy_lon = lat[100:140] + 2e-10, lon[50:90] - 1e-10
+    snapped_lat, snapped_lon = snap_coords(noisy_lat, noisy_lon)
+    assert np.array_equal(snapped_lat, lat[100:140]) and np.array_equal(snapped_lon, lon[50:90])
+
+    rng = np.random.default_rng(0)
+    da = xr.DataArray(rng.integers(1, 30, (3, 40, 40)).astype(np.float32), dims=("time", "lat", "lon"),
+                      coords={"lat": noisy_lat, "lon": noisy_lon})
+    da[0, 5, 5] = np.nan
+    fast = to_grid(da, lat[100:140], lon[50:90])
+    assert np.array_equal(fast.values, da.values, equal_nan=True)  # index path: values untouched
+
+    shifted_lat, shifted_lon = lat[102:130] - 0.3 / 24, lon[52:80] + 0.4 / 24
+    for target in [(shifted_lat, shifted_lon), (shifted_lat[::-1], shifted_lon)]:
+        ours = to_grid(da, *target)
+        ref = da.interp(lat=target[0], lon=target[1])
+        assert np.allclose(ours.values, ref.values, equal_nan=True), np.nanmax(np.abs(ours.values - ref.values))
+    assert snap_dataset(da.assign_coords(lat=noisy_lat + 0.01)).sizes["lat"] == 39
+    print("snapping, index alignment and cached bilinear weights match xarray interp")
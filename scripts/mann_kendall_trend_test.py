@@ -1,62 +1,62 @@
-import xarray as xr
-import numpy as np
-import pymannkendall as mk
+import os
 from pathlib import Path
 
+import netCDF4
+import numpy as np
+
+from metrics_store import MetricsStore
+from mk_trend import MK_METHODS, TREND_FILL, TREND_FLAGS, TREND_TILE, mk_tiles, store_grid
+
 input_dir = Path("nc_output2")
 output_path = "wd50_mk_trend.nc"
-
-wd50_maps = []
-years = []
-
-for file in sorted(input_dir.glob("metrics_wy*.nc")):
-    year = int(file.stem.split("wy")[-1])
-    ds = xr.open_dataset(file)
-    if "wd50" not in ds:
-        continue
-    wd50 = ds["wd50"].expand_dims(time=[year])
-    wd50_maps.append(wd50)
-    years.append(year)
-
-if not wd50_maps:
-    raise RuntimeError("No wd50 data found in NetCDF files.")
-
-wd50_stack = xr.concat(wd50_maps, dim="time")
-wd50_stack = wd50_stack.sortby("time")
-
-def run_mk_test(ts):
-    if np.isnan(ts).all():
-        return np.nan, np.nan, np.nan
-    result = mk.original_test(ts)
-    return result.trend, result.p, result.slope
-
-print("Running Mann-Kendall test...")
-
-mk_results = xr.apply_ufunc(
-    run_mk_test,
-    wd50_stack,
-    input_core_dims=[["time"]],
-    output_core_dims=[[], [], []],
-    vectorize=True,
-    output_dtypes=[object, float, float]
-)
-
-print("Finished Mann-Kendall test.")
-
-trend_map = mk_results[0].rename("trend")
-p_value_map = mk_results[1].rename("p_value")
-slope_map = mk_results[2].rename("slope")
-
-out_ds = xr.Dataset({
-    "trend": trend_map,
-    "p_value": p_value_map,
-    "slope": slope_map
-}, coords={
-    "lat": wd50_stack.lat,
-    "lon": wd50_stack.lon
-}, attrs={
-    "description": "Mann-Kendall trend test results on WD50 from 2012–2025"
-})
-
-out_ds.to_netcdf(output_path)
-print("Saved to wd50_mk_trend.nc")
+variable = "wd50"
+method = "original"  # one of mk_trend.MK_METHODS; "hamed_rao"/"pre_whitened" correct for autocorrelation
+windows = ["water_year"]  # metrics store per window; "seasonal" takes one per season, e.g. djf, mam, jja, son
+alpha = 0.05
+lag = None  # hamed_rao only: autocorrelation lags considered (None = all)
+workers = os.cpu_count()
+complevel = 4  # zlib level of the output variables
+
+
+def main():
+    if method not in MK_METHODS:
+        raise ValueError(f"method must be one of {MK_METHODS}")
+    paths = [str(input_dir / f"metrics_{window}.zarr") for window in windows]
+    lat, lon, _, _, years = store_grid(paths)
+
+    # Tiles are written as they finish, so only a few tiles are ever in memory
+    with netCDF4.Dataset(output_path, "w") as out:
+        out.description = (f"Mann-Kendall trend test results ({method}) on {variable.upper()} "
+                           f"from {years[0]}–{years[-1]}")
+        out.windows = ", ".join(windows)
+        for name, values in (("lat", lat), ("lon", lon)):
+            out.createDimension(name, len(values))
+            out.createVariable(name, "f8", (name,))[:] = values
+        # int8 codes (TREND_FLAGS) and float32 statistics, compressed in tiles the size mk_tiles yields
+        storage = dict(zlib=True, complevel=complevel,
+                       chunksizes=(min(TREND_TILE, len(lat)), min(TREND_TILE, len(lon))))
+        trend = out.createVariable("trend", "i1", ("lat", "lon"), fill_value=TREND_FILL, **storage)
+        trend.setncatts(dict(TREND_FLAGS, long_name=f"Mann-Kendall trend at alpha = {alpha}"))
+        stats = {}
+        units = MetricsStore(paths[0]).open_dataset()[variable].attrs.get("units", "")
+        for name, key, long_name, unit in (("p_value", "p", "two-sided p-value", None),
+                                           ("slope", "slope", "Sen's slope", f"{units} year-1" if units not in ("", "1") else "year-1"),
+                                           ("z", "z", "Mann-Kendall Z score", None),
+                                           ("tau", "tau", "Kendall's tau", None)):
+            stats[key] = out.createVariable(name, "f4", ("lat", "lon"), fill_value=np.float32(np.nan), **storage)
+            stats[key].long_name = long_name
+            if unit:
+                stats[key].units = unit
+
+        print(f"Running Mann-Kendall test ({method})...")
+        for rows, cols, result in mk_tiles(paths, variable, method, alpha, lag, workers):
+            trend[rows, cols] = np.where(np.isnan(result["p"]), TREND_FILL, result["trend"])
+            for key, var in stats.items():
+                var[rows, cols] = result[key].astype(np.float32)
+        print("Finished Mann-Kendall test.")
+
+    print(f"Saved to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+"""Registry of per-cell precipitation metrics evaluated together over a daily cube.
+
+Each metric declares the intermediates it is built from (the wet days sorted
+wettest-first, their cumulative sum, run lengths, rolling sums, ...). For a
+requested set of metrics the engine works out which intermediates are needed,
+computes each of them once per cube, in registration order, and then evaluates
+every metric from the shared results. A new index is one registered function:
+
+    @metric("sdii", needs=("prcptot", "n_wet"), encoding=MM_ENCODING, units="mm/day")
+    def sdii(values, params):
+        ...
+
+Intermediates registered with consumes= reuse the buffer of the one they are
+built from (the cumulative sum overwrites the sorted series in place), so
+everything that needs the consumed intermediate must be registered before it.
+Both are checked at import time.
+
+Run this file directly to check the engine against per-metric references.
+"""
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from wd50_metrics import (
+    DEFAULT_TILE,
+    WET_DAY_THRESHOLD_MM,
+    count_below,
+    iter_blocks,
+    percentile_from_desc,
+    sorted_wet_desc,
+    wdxx_from_cumulative,
+    wet_event_totals,
+)
+
+Intermediate = namedtuple("Intermediate", "name compute needs consumes")
+Metric = namedtuple("Metric", "name compute needs dims encoding attrs params")
+
+INTERMEDIATES = {}
+METRICS = {}
+
+# NetCDF storage of the maps: day counts as small integers, amounts and ratios as scaled integers
+COUNT_ENCODING = {"dtype": "int16", "_FillValue": np.int16(-1)}
+MM_ENCODING = {"dtype": "int32", "scale_factor": 0.01, "add_offset": 0.0, "_FillValue": np.iinfo(np.int32).min}
+RATIO_ENCODING = {"dtype": "int16", "scale_factor": 1e-4, "add_offset": 0.0, "_FillValue": np.iinfo(np.int16).min}
+
+# The five maps every metrics file has carried since wd50_dynamic_6.py
+DEFAULT_METRICS = ("wd50", "prcptot", "r95p", "r95ptot", "r95ptot_frac")
+
+
+def _check_needs(name, needs):
+    for need in needs:
+        if need not in INTERMEDIATES:
+            raise ValueError(f"{name} needs {need!r}, which is not registered before it")
+        if any(item.consumes == need for item in INTERMEDIATES.values()):
+            raise ValueError(f"{name} needs {need!r}, which a registered intermediate already overwrites")
+
+
+def intermediate(name, needs=(), consumes=None):
+    # Register fn(cube, values, params) -> array; values holds the intermediates listed in needs
+    def register(fn):
+        _check_needs(name, needs)
+        if consumes is not None and consumes not in needs:
+            raise ValueError(f"{name} consumes {consumes!r} without needing it")
+        INTERMEDIATES[name] = Intermediate(name, fn, tuple(needs), consumes)
+        return fn
+    return register
+
+
+def metric(name, needs, dims=(), encoding=None, params=(), **attrs):
+    # Register fn(values, params) -> map with shape dims + (lat, lon); encoding is how the map is
+    # stored (one of the *_ENCODING dicts) and attrs go on the output variable, along with the
+    # values of the engine params it is defined by (see metric_attrs)
+    def register(fn):
+        _check_needs(name, needs)
+        METRICS[name] = Metric(name, fn, tuple(needs), tuple(dims), dict(encoding or {}), attrs, tuple(params))
+        return fn
+    return register
+
+
+def metric_attrs(name, **params):
+    # Output attributes of a metric computed with the given compute_metrics keyword arguments
+    return dict(METRICS[name].attrs, **{key: params[key] for key in METRICS[name].params})
+
+
+def plan(metrics):
+    # Names of the intermediates the given metrics need, in the order they are computed
+    needed = set()
+    stack = [need for name in metrics for need in METRICS[name].needs]
+    while stack:
+        name = stack.pop()
+        if name not in needed:
+            needed.add(name)
+            stack.extend(INTERMEDIATES[name].needs)
+    return [name for name in INTERMEDIATES if name in needed]
+
+
+# === Intermediates from the wet days sorted wettest-first ===
+
+@intermediate("desc")
+def _desc(cube, values, params):
+    # Sorted once at the lowest threshold in use; higher thresholds' wet days are a prefix of it
+    return sorted_wet_desc(cube, min((params["wet_threshold"],) + params["wdxx_thresholds"]))
+
+
+@intermediate("n_wet", needs=("desc",))
+def _n_wet(cube, values, params):
+    if min(params["wdxx_thresholds"], default=np.inf) < params["wet_threshold"]:
+        return np.sum(values["desc"] >= params["wet_threshold"], axis=0)
+    return np.count_nonzero(values["desc"], axis=0)
+
+
+@intermediate("n_wet_xx", needs=("desc", "n_wet"))
+def _n_wet_xx(cube, values, params):
+    # Wet-day count at each WDxx threshold
+    return [values["n_wet"] if t == params["wet_threshold"] else np.sum(values["desc"] >= t, axis=0)
+            for t in params["wdxx_thresholds"]]
+
+
+@intermediate("r95_threshold", needs=("desc", "n_wet"))
+def _r95_threshold(cube, values, params):
+    # A fixed base-period map when one is given (see base_quantiles.py); otherwise read off this
+    # cube's sorted series by index, bit-identical to np.nanpercentile of the wet days
+    if params["r95_base"] is not None:
+        return np.asarray(params["r95_base"], dtype=values["desc"].dtype)
+    return percentile_from_desc(values["desc"], values["n_wet"], params["percentile"])
+
+
+@intermediate("r95_count", needs=("desc", "r95_threshold"))
+def _r95_count(cube, values, params):
+    return np.sum(values["desc"] > values["r95_threshold"], axis=0)  # NaN threshold (no wet days) counts nothing
+
+
+@intermediate("cumulative", needs=("desc",), consumes="desc")
+def _cumulative(cube, values, params):
+    return np.cumsum(values["desc"], axis=0, out=values["desc"])
+
+
+@intermediate("prcptot", needs=("cumulative", "n_wet"))
+def _prcptot(cube, values, params):
+    n_wet = values["n_wet"]
+    total = np.take_along_axis(values["cumulative"], np.maximum(n_wet - 1, 0)[None], axis=0)[0]
+    return np.where(n_wet > 0, total, 0).astype(values["cumulative"].dtype)
+
+
+@intermediate("r95_total", needs=("cumulative", "r95_count"))
+def _r95_total(cube, values, params):
+    count = values["r95_count"]
+    tail = np.take_along_axis(values["cumulative"], np.maximum(count - 1, 0)[None], axis=0)[0]
+    return np.where(count > 0, tail, 0).astype(values["cumulative"].dtype)
+
+
+# === Intermediates from the days in calendar order ===
+
+def longest_run(mask):
+    # Longest stretch of consecutive True along axis 0: days since the last False day, maximised
+    count = np.cumsum(mask, axis=0, dtype=np.int32)
+    last_break = np.where(mask, 0, count)
+    np.maximum.accumulate(last_break, axis=0, out=last_break)
+    return np.max(count - last_break, axis=0)
+
+
+@intermediate("n_valid")
+def _n_valid(cube, values, params):
+    return np.count_nonzero(~np.isnan(cube), axis=0)
+
+
+@intermediate("longest_wet_run")
+def _longest_wet_run(cube, values, params):
+    return longest_run(cube >= params["wet_threshold"])  # missing days end a run
+
+
+@intermediate("longest_dry_run")
+def _longest_dry_run(cube, values, params):
+    return longest_run(cube < params["wet_threshold"])
+
+
+@intermediate("daily_max")
+def _daily_max(cube, values, params):
+    return np.fmax.reduce(cube, axis=0)  # ignores NaN days; NaN only if every day is missing
+
+
+@intermediate("rolling_max")
+def _rolling_max(cube, values, params):
+    # Largest total over rx_days consecutive days, missing days counted as zero
+    window = min(params["rx_days"], cube.shape[0])
+    sums = np.cumsum(np.nan_to_num(cube, nan=0.0), axis=0, dtype=np.float64)
+    totals = sums[window - 1:].copy()
+    totals[1:] -= sums[:-window]
+    return np.max(totals, axis=0).astype(np.float32)
+
+
+@intermediate("event_totals")
+def _event_totals(cube, values, params):
+    return wet_event_totals(cube, params["wet_threshold"])
+
+
+@intermediate("n_events", needs=("event_totals",))
+def _n_events(cube, values, params):
+    return np.count_nonzero(values["event_totals"], axis=0)
+
+
+@intermediate("event_cumulative", needs=("event_totals",), consumes="event_totals")
+def _event_cumulative(cube, values, params):
+    # Event totals sorted largest-first and summed in place, the storm analogue of cumulative
+    totals = values["event_totals"]
+    totals.sort(axis=0)
+    desc = totals[::-1]
+    return np.cumsum(desc, axis=0, out=desc)
+
+
+# === Metrics ===
+
+@metric("wd50", needs=("cumulative", "prcptot"), encoding=COUNT_ENCODING, units="1",
+        long_name="number of wettest days contributing 50% of PRCPTOT")
+def wd50(values, params):
+    prcptot = values["prcptot"]
+    counts = count_below(values["cumulative"], prcptot / 2)
+    return np.where(prcptot > 0, counts + 1, np.nan)
+
+
+@metric("prcptot", needs=("prcptot",), encoding=MM_ENCODING, units="mm", long_name="total wet-day precipitation")
+def prcptot(values, params):
+    return values["prcptot"]
+
+
+@metric("r95p", needs=("r95_count",), encoding=COUNT_ENCODING, units="1",
+        long_name="number of wet days above the 95th percentile of wet days")
+def r95p(values, params):
+    return values["r95_count"]
+
+
+@metric("r95ptot", needs=("r95_total",), encoding=MM_ENCODING, units="mm", long_name="precipitation on R95p days")
+def r95ptot(values, params):
+    return values["r95_total"]
+
+
+@metric("r95ptot_frac", needs=("r95_total", "prcptot"), encoding=RATIO_ENCODING, units="1",
+        long_name="R95pTOT / PRCPTOT")
+def r95ptot_frac(values, params):
+    prcptot = values["prcptot"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(prcptot > 0, values["r95_total"] / prcptot, np.nan)
+
+
+@metric("wdxx", needs=("cumulative", "n_wet_xx"), dims=("fraction", "threshold"), encoding=COUNT_ENCODING, units="1",
+        long_name="number of wettest days contributing the given fraction of PRCPTOT")
+def wdxx(values, params):
+    # Every (fraction, threshold) pair reads the one cumulative series; WDxx(0.5, wet_threshold) == wd50
+    return np.stack([wdxx_from_cumulative(values["cumulative"], n_wet, params["wdxx_fractions"])
+                     for n_wet in values["n_wet_xx"]], axis=1)
+
+
+@metric("sdii", needs=("prcptot", "n_wet"), encoding=MM_ENCODING, units="mm/day",
+        long_name="simple daily intensity index")
+def sdii(values, params):
+    n_wet = values["n_wet"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(n_wet > 0, values["prcptot"] / n_wet, np.nan).astype(np.float32)
+
+
+@metric("cdd", needs=("longest_dry_run", "n_valid"), encoding=COUNT_ENCODING, units="1",
+        long_name="maximum consecutive dry days")
+def cdd(values, params):
+    return np.where(values["n_valid"] > 0, values["longest_dry_run"], np.nan).astype(np.float32)
+
+
+@metric("cwd", needs=("longest_wet_run", "n_valid"), encoding=COUNT_ENCODING, units="1",
+        long_name="maximum consecutive wet days")
+def cwd(values, params):
+    return np.where(values["n_valid"] > 0, values["longest_wet_run"], np.nan).astype(np.float32)
+
+
+@metric("rx1day", needs=("daily_max",), encoding=MM_ENCODING, units="mm", long_name="maximum 1-day precipitation")
+def rx1day(values, params):
+    return values["daily_max"]
+
+
+@metric("rxnday", needs=("rolling_max", "n_valid"), encoding=MM_ENCODING, params=("rx_days",), units="mm",
+        long_name="maximum precipitation over rx_days consecutive days")
+def rxnday(values, params):
+    return np.where(values["n_valid"] > 0, values["rolling_max"], np.nan).astype(np.float32)
+
+
+@metric("event_wd50", needs=("event_cumulative",), encoding=COUNT_ENCODING, units="events",
+        long_name="number of largest wet-day events (runs of consecutive wet days) contributing 50% of PRCPTOT")
+def event_wd50(values, params):
+    cumulative = values["event_cumulative"]
+    total = cumulative[-1]
+    return np.where(total > 0, count_below(cumulative, total / 2) + 1, np.nan)
+
+
+@metric("n_events", needs=("n_events", "n_valid"), encoding=COUNT_ENCODING, units="events",
+        long_name="number of wet-day events (runs of consecutive wet days)")
+def n_events(values, params):
+    return np.where(values["n_valid"] > 0, values["n_events"], np.nan).astype(np.float32)
+
+
+# === Engine ===
+
+def compute_metrics(cube, metrics=DEFAULT_METRICS, wet_threshold=WET_DAY_THRESHOLD_MM, percentile=95,
+                    wdxx_fractions=(0.5,), wdxx_thresholds=(WET_DAY_THRESHOLD_MM,), rx_days=5, r95_base=None):
+    # {name: map} for the requested metrics, computing each intermediate they share once.
+    # Sums agree with np.nansum to float32 rounding; wd50 and r95p match the per-cell references exactly.
+    # r95_base is an optional (lat, lon) threshold map that replaces the cube's own percentile.
+    if cube.shape[0] == 0:
+        raise ValueError("cube has no days")
+    unknown = [name for name in metrics if name not in METRICS]
+    if unknown:
+        raise ValueError(f"unknown metrics {unknown}; registered: {sorted(METRICS)}")
+    params = {
+        "wet_threshold": wet_threshold,
+        "percentile": percentile,
+        "wdxx_fractions": tuple(wdxx_fractions),
+        # Thresholds only widen the shared sort when WDxx is actually requested
+        "wdxx_thresholds": tuple(wdxx_thresholds) if "wdxx" in metrics and len(wdxx_fractions) else (),
+        "rx_days": rx_days,
+        "r95_base": r95_base,
+    }
+    values = {}
+    for name in plan(metrics):
+        item = INTERMEDIATES[name]
+        values[name] = item.compute(cube, values, params)
+        if item.consumes:
+            del values[item.consumes]
+    return {name: METRICS[name].compute(values, params) for name in metrics}
+
+
+def compute_metrics_tiled(cube, workers=None, tile=DEFAULT_TILE, decode=None, **kwargs):
+    # compute_metrics over spatial blocks on a thread pool: (lat, lon) tiles of a gridded cube, or
+    # runs of cells of a packed (time, cell) one. Blocks are views of the one cube, so nothing is
+    # copied between workers, and NumPy's sort/cumsum release the GIL, so the blocks run on
+    # separate cores. Per-block temporaries also keep peak memory near one cube. decode turns a
+    # block of stored values (e.g. scaled_ppt codes) into float mm just before it is computed.
+    workers = workers or os.cpu_count() or 1
+    spatial = cube.shape[1:]
+    blocks = list(iter_blocks(spatial, tile))
+
+    def run(block):
+        # Map parameters such as r95_base are cut to the block along with the cube
+        block_kwargs = {key: value[block] if isinstance(value, np.ndarray) and value.shape == spatial
+                        else value for key, value in kwargs.items()}
+        block_cube = cube[(slice(None),) + block]
+        return compute_metrics(decode(block_cube) if decode else block_cube, **block_kwargs)
+
+    if workers == 1 or len(blocks) == 1:
+        results = [run(block) for block in blocks]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run, blocks))
+
+    # Maps may carry leading dimensions (wdxx is fraction x threshold); blocks split the spatial ones
+    maps = {name: np.empty(value.shape[:value.ndim - len(spatial)] + spatial, dtype=value.dtype)
+            for name, value in results[0].items()}
+    for block, result in zip(blocks, results):
+        for name, value in result.items():
+            maps[name][(Ellipsis,) + block] = value
+    return maps
+
+
+if __name__ == "__main__":
+    from scaled_ppt import decode_ppt, encode_ppt
+    from wd50_metrics import calculate_event_wd50, calculate_wd50, synthetic_cube
+
+    def reference_longest_run(series, condition):
+        best = run = 0
+        for value in series:
+            run = run + 1 if condition(value) else 0
+            best = max(best, run)
+        return best
+
+    rng = np.random.default_rng(0)
+    all_metrics = tuple(METRICS)
+    for seed, shape in enumerate([(365, 40, 50), (366, 7, 3), (30, 20, 20), (3, 4, 5)]):
+        cube = synthetic_cube(shape, seed)
+        wet = np.where(cube >= WET_DAY_THRESHOLD_MM, cube, np.nan)
+
+        sweep = dict(wdxx_fractions=(0.25, 0.5, 0.75, 0.9), wdxx_thresholds=(0.1, 1.0, 5.0))
+        tiled = compute_metrics_tiled(cube, metrics=all_metrics, workers=4, tile=(16, 16), **sweep)
+        for name, value in compute_metrics(cube, all_metrics, **sweep).items():
+            assert np.array_equal(value, tiled[name], equal_nan=True), (name, shape)
+        for name in all_metrics:
+            value = compute_metrics(cube, (name,), **sweep)[name]
+            assert np.array_equal(value, tiled[name], equal_nan=True), (name, shape)
+        # Blocks of stored codes decoded on the fly give what the decoded cube gives
+        codes = encode_ppt(cube)
+        decoded = compute_metrics_tiled(codes, metrics=all_metrics, workers=4, tile=(16, 16), decode=decode_ppt,
+                                        **sweep)
+        for name, value in compute_metrics(decode_ppt(codes), all_metrics, **sweep).items():
+            assert np.array_equal(value, decoded[name], equal_nan=True), (name, shape)
+        # Packed (time, cell) cubes give the same values cell for cell
+        packed = compute_metrics_tiled(cube.reshape(shape[0], -1), metrics=all_metrics, workers=4, tile=(8, 8), **sweep)
+        for name, value in packed.items():
+            assert np.array_equal(value, tiled[name].reshape(value.shape), equal_nan=True), (name, shape)
+
+        expected_wd50 = np.apply_along_axis(calculate_wd50, 0, wet)
+        assert np.array_equal(tiled["wd50"], expected_wd50, equal_nan=True), shape
+        assert np.array_equal(tiled["wdxx"][1, 1], expected_wd50, equal_nan=True), shape
+        expected_event_wd50 = np.apply_along_axis(calculate_event_wd50, 0, cube)
+        assert np.array_equal(tiled["event_wd50"], expected_event_wd50, equal_nan=True), shape
+        for j, t in enumerate(sweep["wdxx_thresholds"]):
+            cumulative = np.cumsum(sorted_wet_desc(cube, t), axis=0)
+            for i, f in enumerate(sweep["wdxx_fractions"]):
+                counts = np.sum(cumulative < cumulative[-1] * f, axis=0)
+                ref = np.where(cumulative[-1] > 0, counts + 1, np.nan)
+                assert np.array_equal(tiled["wdxx"][i, j], ref, equal_nan=True), (f, t, shape)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            n_wet = np.sum(~np.isnan(wet), axis=0)
+            assert np.allclose(tiled["sdii"], np.nansum(wet, axis=0) / n_wet, equal_nan=True), shape
+        valid = np.any(~np.isnan(cube), axis=0)
+        for name, condition in [("cwd", lambda v: v >= WET_DAY_THRESHOLD_MM), ("cdd", lambda v: v < WET_DAY_THRESHOLD_MM)]:
+            ref = np.apply_along_axis(reference_longest_run, 0, cube, condition).astype(float)
+            assert np.array_equal(tiled[name], np.where(valid, ref, np.nan), equal_nan=True), (name, shape)
+        filled = np.nan_to_num(cube)
+        window = min(5, shape[0])
+        ref = np.max([filled[d:d + window].sum(axis=0) for d in range(shape[0] - window + 1)], axis=0)
+        assert np.allclose(tiled["rxnday"], np.where(valid, ref, np.nan), equal_nan=True), shape
+        assert np.array_equal(tiled["rx1day"], np.where(valid, np.nanmax(np.where(valid, cube, 0), axis=0), np.nan),
+                              equal_nan=True), shape
+        # A base-period threshold map: r95p counts the wet days above it, r95ptot sums them
+        base = np.where(valid, rng.uniform(1.0, 20.0, shape[1:]), np.nan).astype(np.float32)
+        fixed = compute_metrics_tiled(cube, metrics=("r95p", "r95ptot"), workers=4, tile=(16, 16), r95_base=base)
+        assert np.array_equal(fixed["r95p"], np.sum(wet > base, axis=0)), shape
+        assert np.allclose(fixed["r95ptot"], np.nansum(np.where(wet > base, wet, 0), axis=0), rtol=1e-5), shape
+    print("registry metrics match per-metric references; tiled matches untiled; subsets match the full set")
@@ -0,0 +1,32 @@
+"""Writing metric NetCDF files safely and checking whether existing ones are current."""
+import os
+import threading
+
+import xarray as xr
+
+
+def write_netcdf_atomic(ds, path, encoding=None):
+    # Write next to the target under a dot-prefixed name, then rename over it. The rename is
+    # atomic on one filesystem, so readers globbing metrics_wy*.nc never see a half-written file.
+    # The temp name is built rather than taken from mkstemp, which would create it owner-only (0600)
+    # and the rename would keep that; to_netcdf creates it with the umask's permissions.
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".tmp_{os.getpid()}_{threading.get_ident()}_{name}")
+    try:
+        ds.to_netcdf(tmp_path, encoding=encoding)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def output_attrs(path):
+    # Global attributes of an existing output, or None if it is missing or unreadable
+    if not os.path.exists(path):
+        return None
+    try:
+        with xr.open_dataset(path) as ds:
+            return dict(ds.attrs)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,295 @@
+"""Appendable (time, lat, lon) store of every year's metric maps.
+
+One Zarr store per window (water year, DJF, ...) replaces the directory of
+per-year NetCDF files that every plotting and trend script used to glob, open
+and concatenate. The layout is plain xarray-readable Zarr:
+
+    time              int32 year the window ends in, starting at STORE_EPOCH_YEAR
+    lat/lon           cell centres of the grid, plus fraction/threshold for the WDxx family
+    <metric>          (time, [fraction, threshold,] lat, lon) scaled integers with the
+                      metric's CF encoding (metric_registry.py), so xarray decodes them
+    stable_days       int16 (time) days of each year that were stable; -1 for years never written
+    provisional_days  int16 (time) provisional/early days each year was computed from
+    config_hash       str (time) run config hash each year was computed with; "" if never written
+    pipeline_version, region, grid, r95_threshold
+                      str (time) the run attributes each year was computed with, as save_metrics sets them
+
+Maps are chunked (TIME_CHUNK, SPACE_CHUNK, SPACE_CHUNK): one year's map is a
+few dozen chunk reads and a per-cell series over 40 years is three. Writing a
+year rewrites only the chunks of its time block. stable_days is written last,
+so readers (open_dataset) only ever see years whose maps are complete.
+The config hash is kept per year, so a run under a new config rewrites only
+the years it covers and every other year keeps its maps (and its old hash,
+which tells the pipeline to recompute it whenever it is next in range).
+Metrics new to the store get their own array, empty for earlier years, and
+metrics a config no longer computes are cleared in the years it rewrites. A
+change that would alter the layout of stored arrays (a different grid, WDxx
+fractions/thresholds, encoding or metric parameter such as rx_days) raises instead of touching the store; move
+it aside to start a new one. Writers take the same exclusive lock file as the
+daily archive.
+
+Plotting and analysis code should go through load_metrics: it opens a store
+once per process, puts lat/lon in ascending order once, and reads each
+variable from disk only the first time it is asked for. The cache is keyed by
+the store's mtime, so a pipeline run in between is picked up on the next call.
+Run this file without arguments to check writes, reloads and layout refusals,
+or with a directory of per-year files to import them.
+"""
+import os
+
+import numpy as np
+import xarray as xr
+import zarr
+
+from daily_archive import ARCHIVE_EPOCH, SPACE_CHUNK, locked
+
+STORE_EPOCH_YEAR = ARCHIVE_EPOCH.year
+_loaded = {}  # absolute store path -> (mtime, normalized Dataset), see load_metrics
+TIME_CHUNK = 16  # years
+# Run attributes that can change from one run to the next are kept per year, not in the group attrs
+YEAR_RUN_ATTRS = ("config_hash", "pipeline_version", "region", "grid", "r95_threshold")
+YEAR_ATTRS = ("description", "window_start", "window_end", "stable_days", "provisional_days") + YEAR_RUN_ATTRS
+YEAR_COORDS = ("stable_days", "provisional_days") + YEAR_RUN_ATTRS
+
+
+def encode_values(values, encoding):
+    # Float map -> the integer codes xarray would write for this CF encoding, NaN -> _FillValue
+    values = np.asarray(values)
+    if values.dtype.kind in "mM":
+        raise TypeError("Got datetime/timedelta values; open the source with decode_timedelta=False")
+    values = values.astype(np.float64)
+    codes = np.rint((values - encoding.get("add_offset", 0.0)) / encoding.get("scale_factor", 1.0))
+    codes[np.isnan(values)] = encoding["_FillValue"]
+    return codes.astype(encoding["dtype"])
+
+
+class MetricsStore:
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, "zarr.json"))
+
+    def _group(self, mode="r"):
+        return zarr.open_group(self.path, mode=mode)
+
+    def _create(self, ds):
+        group = zarr.open_group(self.path, mode="w")
+        group.attrs.update({k: v for k, v in ds.attrs.items() if k not in YEAR_ATTRS})
+        group.attrs["description"] = f"Precipitation metrics by {ds.attrs.get('window', 'water_year')}"
+        group.create_array("time", shape=(0,), chunks=(4096,), dtype="int32", fill_value=0,
+                           dimension_names=["time"], attributes={"long_name": "year the window ends in"})
+        for dim in ("lat", "lon"):
+            group.create_array(dim, data=np.asarray(ds[dim].values, dtype=np.float64),
+                               dimension_names=[dim], attributes=dict(ds[dim].attrs))
+        for name in ("stable_days", "provisional_days"):
+            group.create_array(name, shape=(0,), chunks=(4096,), dtype="int16", fill_value=-1,
+                               dimension_names=["time"])
+        for name in YEAR_RUN_ATTRS:
+            group.create_array(name, shape=(0,), chunks=(4096,), dtype=str, fill_value="",
+                               dimension_names=["time"], attributes={"long_name": f"{name} the year was computed with"})
+        return group
+
+    def _check_layout(self, group, ds, encoding):
+        # Add arrays for metrics (and their extra dimensions) new to the store; refuse anything that
+        # would change the layout of what is already stored
+        def mismatch(what):
+            return ValueError(f"{self.path} holds {what} than this run writes; stored years are never "
+                              "dropped, so move the store aside to start a new one")
+
+        for dim in ("lat", "lon") + tuple(d for d in ("fraction", "threshold") if d in ds.coords):
+            values = np.asarray(ds[dim].values, dtype=np.float64)
+            if dim not in group:
+                group.create_array(dim, data=values, dimension_names=[dim], attributes=dict(ds[dim].attrs))
+            elif group[dim].shape != values.shape or not np.allclose(group[dim][:], values):
+                raise mismatch("a different grid" if dim in ("lat", "lon") else f"other {dim} values")
+        for name, da in ds.data_vars.items():
+            enc = encoding[name]
+            if name not in group:
+                extra = da.shape[:-2]
+                attrs = dict(da.attrs, _FillValue=int(enc["_FillValue"]), coordinates=" ".join(YEAR_COORDS))
+                if "scale_factor" in enc:
+                    attrs.update(scale_factor=float(enc["scale_factor"]), add_offset=float(enc.get("add_offset", 0.0)))
+                group.create_array(name, shape=group["time"].shape + da.shape, dtype=enc["dtype"],
+                                   fill_value=enc["_FillValue"],
+                                   chunks=(TIME_CHUNK,) + (1,) * len(extra) + (SPACE_CHUNK, SPACE_CHUNK),
+                                   dimension_names=["time"] + list(da.dims), attributes=attrs)
+                continue
+            array = group[name]
+            params = {key: value for key, value in da.attrs.items() if not isinstance(value, str)}  # e.g. rx_days
+            stored = (array.shape[1:], np.dtype(array.dtype), array.attrs.get("scale_factor", 1.0),
+                      array.attrs.get("add_offset", 0.0), {key: array.attrs.get(key) for key in params})
+            wanted = (da.shape, np.dtype(enc["dtype"]), float(enc.get("scale_factor", 1.0)),
+                      float(enc.get("add_offset", 0.0)), params)
+            if stored != wanted:
+                raise mismatch(f"{name} in another shape, encoding or parameters")
+
+    def _grow(self, group, end):
+        # Extend the time axis so it covers years [STORE_EPOCH_YEAR, STORE_EPOCH_YEAR + end)
+        old_end = group["time"].shape[0]
+        if end <= old_end:
+            return
+        for name, array in group.arrays():
+            if array.metadata.dimension_names and array.metadata.dimension_names[0] == "time":
+                array.resize((end,) + array.shape[1:])
+        group["time"][old_end:] = np.arange(STORE_EPOCH_YEAR + old_end, STORE_EPOCH_YEAR + end, dtype=np.int32)
+
+    def write_year(self, year, ds, encoding):
+        # Store one year's (.., lat, lon) maps from a save_metrics Dataset, recording the run's
+        # config_hash and other YEAR_RUN_ATTRS for that year; encoding maps each variable to its CF
+        # integer encoding
+        index = year - STORE_EPOCH_YEAR
+        if index < 0:
+            raise ValueError(f"{year} is before the store epoch {STORE_EPOCH_YEAR}")
+        with locked(self.path):
+            if self.exists():
+                group = self._group("r+")
+            else:
+                group = self._create(ds)
+            self._check_layout(group, ds, encoding)
+            self._grow(group, index + 1)
+            for name, da in ds.data_vars.items():
+                group[name][index] = encode_values(da.values, encoding[name])
+            for name, array in group.arrays():
+                # Metrics this config no longer computes must not keep an older run's maps for the year
+                if name not in ds.data_vars and name not in ("time",) + YEAR_COORDS and \
+                        array.metadata.dimension_names[0] == "time":
+                    array[index] = array.fill_value
+            group["provisional_days"][index] = ds.attrs.get("provisional_days", 0)
+            for name in YEAR_RUN_ATTRS:
+                group[name][index] = str(ds.attrs.get(name, ""))
+            group["stable_days"][index] = ds.attrs.get("stable_days", 0)
+
+    def year_config(self, year):
+        # Config hash a stored year was computed with, or None if it was never written
+        if self.year_days(year) is None:
+            return None
+        return str(self._group()["config_hash"][year - STORE_EPOCH_YEAR])
+
+    def year_days(self, year):
+        # (stable_days, provisional_days) a stored year was computed from, or None if it was never written
+        index = year - STORE_EPOCH_YEAR
+        if not self.exists() or not 0 <= index < self._group()["time"].shape[0]:
+            return None
+        group = self._group()
+        stable = int(group["stable_days"][index])
+        return None if stable < 0 else (stable, int(group["provisional_days"][index]))
+
+    def mtime(self):
+        # Changes whenever a year is written (stable_days is written last) or the store is recreated
+        paths = [os.path.join(self.path, "zarr.json")]
+        for root, _, files in os.walk(os.path.join(self.path, "stable_days")):
+            paths += [os.path.join(root, name) for name in files]
+        return max(os.path.getmtime(path) for path in paths)
+
+    def open_dataset(self):
+        # Lazy xarray view of every written year
+        ds = xr.open_zarr(self.path, consolidated=False, chunks=None)
+        ds = ds.set_coords(list(YEAR_COORDS))
+        return ds.isel(time=np.flatnonzero(ds["stable_days"].values >= 0))
+
+
+def load_metrics(path, start=None, end=None, variables=None):
+    # Years start..end (inclusive, None = open ended) of a store with ascending lat/lon. Requested
+    # variables (default all) are read into memory once per process and shared by later calls
+    # until the store changes on disk; selections of the result are views of the cached arrays.
+    store = MetricsStore(path)
+    if not store.exists():
+        raise RuntimeError(f"No metrics store at {path}")
+    key, mtime = os.path.abspath(path), store.mtime()
+    cached = _loaded.get(key)
+    if cached is None or cached[0] != mtime:
+        if cached is not None:
+            cached[1].close()
+        ds = store.open_dataset()
+        if ds.sizes["lat"] > 1 and ds.lat[0] > ds.lat[-1]:
+            ds = ds.isel(lat=slice(None, None, -1))
+        if ds.sizes["lon"] > 1 and ds.lon[0] > ds.lon[-1]:
+            ds = ds.isel(lon=slice(None, None, -1))
+        _loaded[key] = cached = (mtime, ds)
+    ds = cached[1]
+    names = list(ds.data_vars) if variables is None else list(variables)
+    for name in names:
+        ds.variables[name].load()  # in place, so the cached Dataset keeps the values
+    ds = ds[names].sel(time=slice(start, end))
+    if ds.sizes["time"] == 0:
+        raise RuntimeError(f"No years {start}–{end} in {path}")
+    return ds
+
+
+if __name__ == "__main__":
+    # python metrics_store.py nc_output2 [store path] consolidates existing per-year files; without
+    # arguments, check writes, reloads and layout refusals on a scratch store
+    import re
+    import shutil
+    import sys
+    import tempfile
+
+    from metric_registry import METRICS
+
+    if len(sys.argv) > 1:
+        from grids import snap_dataset
+
+        directory = sys.argv[1]
+        store = MetricsStore(sys.argv[2] if len(sys.argv) > 2 else os.path.join(directory, "metrics_water_year.zarr"))
+        config_hash = None
+        for name in sorted(os.listdir(directory)):
+            match = re.fullmatch(r"metrics_wy(\d{4})\.nc", name)
+            if not match:
+                continue
+            with xr.open_dataset(os.path.join(directory, name)) as ds:
+                ds = snap_dataset(ds[[var for var in ds.data_vars if var in METRICS]].load())
+            # Files written without a config hash get a placeholder, so a pipeline run recomputes each of
+            # those years once its range covers it; years it does not cover stay as imported
+            config_hash = config_hash or ds.attrs.get("config_hash", "imported")
+            ds.attrs["config_hash"] = config_hash
+            store.write_year(int(match.group(1)), ds, {var: METRICS[var].encoding for var in ds.data_vars})
+            print(f"Added {name} to {store.path}")
+        sys.exit()
+
+    scratch = tempfile.mkdtemp()
+    path = os.path.join(scratch, "metrics_water_year.zarr")
+    store = MetricsStore(path)
+    lat, lon = np.linspace(40, 39, 3), np.linspace(-120, -119, 4)
+
+    def year_ds(year, names, config_hash, lat=lat, rx_days=5, **attrs):
+        maps = {name: (("lat", "lon"), np.full((len(lat), len(lon)), year % 100 + i, dtype=np.float32),
+                       {"rx_days": rx_days} if name == "rxnday" else {})
+                for i, name in enumerate(names)}
+        attrs = dict({"window": "water_year", "stable_days": 365, "provisional_days": 0,
+                      "config_hash": config_hash, "pipeline_version": "6.4"}, **attrs)
+        return xr.Dataset(maps, coords={"lat": lat, "lon": lon}, attrs=attrs)
+
+    def write(year, ds):
+        store.write_year(year, ds, {name: METRICS[name].encoding for name in ds.data_vars})
+
+    write(2012, year_ds(2012, ("wd50", "prcptot"), "config-a"))
+    write(2013, year_ds(2013, ("wd50", "prcptot", "sdii", "rxnday"), "config-b", pipeline_version="6.5"))
+    ds = load_metrics(path)
+    assert list(ds.time.values) == [2012, 2013] and store.year_days(2011) is None
+    assert store.year_config(2012) == "config-a" and store.year_config(2013) == "config-b"
+    assert list(ds.pipeline_version.values) == ["6.4", "6.5"] and float(ds.lat[0]) < float(ds.lat[-1])
+    assert np.all(ds.wd50.sel(time=2013) == 13) and np.all(np.isnan(ds.sdii.sel(time=2012)))
+
+    # Rewriting a year under a config without prcptot clears its stale map and keeps the other year's;
+    # load_metrics picks the rewrite up from the store's new mtime
+    write(2012, year_ds(2012, ("wd50",), "config-c", provisional_days=3))
+    ds = load_metrics(path)
+    assert store.year_config(2012) == "config-c" and store.year_days(2012) == (365, 3)
+    assert np.all(np.isnan(ds.prcptot.sel(time=2012))) and np.all(ds.prcptot.sel(time=2013) == 14)
+
+    # Another grid, encoding or rx_days is refused and leaves the store as it was
+    mtime = store.mtime()
+    coarser = {"prcptot": dict(METRICS["prcptot"].encoding, scale_factor=0.1)}
+    for ds, encoding in ((year_ds(2014, ("wd50",), "config-d", lat=lat + 0.5), {"wd50": METRICS["wd50"].encoding}),
+                         (year_ds(2014, ("prcptot",), "config-d"), coarser),
+                         (year_ds(2014, ("rxnday",), "config-d", rx_days=7), {"rxnday": METRICS["rxnday"].encoding})):
+        try:
+            store.write_year(2014, ds, encoding)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected a ValueError")
+    assert store.mtime() == mtime and store.year_days(2014) is None
+    shutil.rmtree(scratch)
+    print("metrics store per-year configs, cleared metrics, reloads and layout refusals check out")
@@ -0,0 +1,318 @@
+"""Mann-Kendall trend test and Sen's slope for every grid cell at once.
+
+pymannkendall tests one series per call, rebuilding its O(n^2) pairwise
+comparisons in Python each time. For a few decades of annual maps the pairs
+are small: with n years there are n(n-1)/2 of them (630 for 36 years), so a
+block of cells is handled as one (cells, pairs) array of differences x[j] - x[i]:
+
+    S       sum of sign(x[j] - x[i]) over the pairs
+    var(S)  n(n-1)(2n+5)/18 less the tie correction sum t(t-1)(2t+5)/18 over
+            groups of t equal values. Each value tied with e others adds
+            e(2e+7), so the correction is a count of equal values per row
+    Z, p    continuity-corrected normal score and its two-sided p-value
+    slope   median of (x[j] - x[i]) / (j - i), Sen's estimator, from one row-wise sort
+
+Missing years (NaN) are skipped per cell the way pymannkendall skips them:
+S, var(S) and tau use that cell's valid years, and the slope uses every pair
+of valid years at their real spacing.
+
+The autocorrelation-corrected variants of MK_METHODS follow pymannkendall's
+hamed_rao_modification_test and trend_free_pre_whitening_modification_test,
+and "seasonal" its seasonal_test with one metrics store per season. Ranks and
+autocorrelations are taken row-wise over the same blocks.
+
+mk_tiles runs a whole store grid on a process pool: each worker reads one
+TREND_TILE x TREND_TILE tile of the store and hands back its maps. Only
+TILES_IN_FLIGHT tiles per worker are submitted ahead of the caller, so memory
+stays bounded by the tile size whatever the grid size, and the caller writes
+tiles out as they arrive. Run this file directly to check every method against pymannkendall.
+"""
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+import numpy as np
+from scipy.stats import norm
+
+from daily_archive import SPACE_CHUNK
+from metrics_store import MetricsStore
+
+MK_CHUNK = 4096  # cells per block; the pair arrays are ~n^2/2 * MK_CHUNK float64s
+TREND_TILE = 2 * SPACE_CHUNK  # cells per side of the tiles handed to worker processes
+TILES_IN_FLIGHT = 2  # tiles per worker submitted ahead of the caller, see mk_tiles
+
+# original: Mann (1945) / Kendall (1975); hamed_rao: variance corrected for autocorrelation,
+# Hamed and Rao (1998); pre_whitened: trend-free pre-whitening, Yue and Wang (2002);
+# seasonal: Hirsch and Slack (1984), one series per season summed
+MK_METHODS = ("original", "hamed_rao", "pre_whitened", "seasonal")
+MK_MIN_YEARS = {"original": 2, "hamed_rao": 3, "pre_whitened": 3, "seasonal": 2}  # valid years a cell needs
+
+TREND_DECREASING = -1
+TREND_NONE = 0
+TREND_INCREASING = 1
+TREND_LABELS = {TREND_DECREASING: "decreasing", TREND_NONE: "no trend", TREND_INCREASING: "increasing"}
+TREND_FILL = -128  # int8 trend code of cells without enough years to test
+# CF flag attributes of a stored int8 trend variable
+TREND_FLAGS = {"flag_values": np.array(list(TREND_LABELS), dtype=np.int8),
+               "flag_meanings": " ".join(label.replace(" ", "_") for label in TREND_LABELS.values())}
+
+
+def pair_indices(n):
+    # (i, j) of every pair with i < j, in pymannkendall's order
+    return np.triu_indices(n, k=1)
+
+
+def pair_diffs(xt):
+    # (cell, pair) differences x[j] - x[i] of (cell, time) rows, NaN where either value is missing,
+    # with the pair indices. np.take keeps the rows contiguous (fancy indexing along axis 1 would
+    # return a column-major array and slow the row sorts)
+    i, j = pair_indices(xt.shape[1])
+    return np.take(xt, j, axis=1) - np.take(xt, i, axis=1), i, j
+
+
+def mk_score(diffs):
+    return (np.count_nonzero(diffs > 0, axis=1) - np.count_nonzero(diffs < 0, axis=1)).astype(np.float64)
+
+
+def tie_variance(xt, n):
+    # var(S) of (cell, time) rows with n valid values each: each valid value with e equal partners adds e(2e + 7)
+    partners = np.maximum(np.count_nonzero(xt[:, :, None] == xt[:, None, :], axis=2) - 1, 0)
+    return (n * (n - 1) * (2 * n + 5) - np.sum(partners * (2 * partners + 7), axis=1)) / 18
+
+
+def row_median(values, count):
+    # Median of the first count entries of each sorted row (NaNs sort last), NaN where count is 0
+    rows = np.arange(len(values))
+    lo = values[rows, np.maximum(count - 1, 0) // 2]
+    hi = values[rows, count // 2]
+    return np.where(count > 0, (lo + hi) / 2, np.nan)
+
+
+def sens_slope(slopes):
+    # Sen's slope from (cell, pair) slopes (x[j] - x[i]) / (j - i): the median over the valid pairs,
+    # from one row-wise sort (in place) that puts the NaN pairs last
+    slopes.sort(axis=1)
+    return row_median(slopes, np.count_nonzero(~np.isnan(slopes), axis=1))
+
+
+def compact(xt):
+    # Rows with their valid values moved to the front in order and the NaNs after them, which is
+    # the series pymannkendall tests once it has skipped the missing years
+    return np.take_along_axis(xt, np.argsort(np.isnan(xt), axis=1, kind="stable"), axis=1)
+
+
+def rank_rows(xt):
+    # Average ranks (scipy.stats.rankdata) of the valid values of each row, NaN elsewhere
+    below = np.count_nonzero(xt[:, :, None] > xt[:, None, :], axis=2)
+    equal = np.count_nonzero(xt[:, :, None] == xt[:, None, :], axis=2)
+    return np.where(np.isnan(xt), np.nan, below + (equal + 1) / 2)
+
+
+def autocorrelation(xt, n, lags):
+    # (cell, lags + 1) sample autocorrelation of compacted rows (n valid values first), 0 past
+    # lag n - 1 and NaN for constant rows. Rows are grouped by n and each lag is a dot product,
+    # so the values match pymannkendall's __acf bit for bit: the pre-whitened series are
+    # compared for exact ties afterwards.
+    acf = np.zeros((len(xt), lags + 1))
+    for count in np.unique(n).astype(int):
+        rows = np.flatnonzero(n == count)
+        y = xt[rows, :count]
+        y = y - y.mean(axis=1, keepdims=True)
+        acov = np.stack([(y[:, None, :count - k] @ y[:, k:, None])[:, 0, 0] / count
+                         for k in range(min(lags, count - 1) + 1)], axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            acf[rows, :acov.shape[1]] = acov / acov[:, :1]
+    return acf
+
+
+def hamed_rao_factor(xt, n, slope, alpha, lag):
+    # Hamed and Rao (1998) variance inflation n/n* from the significant autocorrelations of the
+    # ranks of the Sen-detrended series; lag=None uses every lag
+    packed = compact(xt)
+    ranks = rank_rows(packed - np.arange(1, xt.shape[1] + 1) * slope[:, None])
+    lags = xt.shape[1] - 1 if lag is None else min(lag, xt.shape[1] - 1)
+    acf = autocorrelation(ranks, n, lags)[:, 1:]
+    k = np.arange(1, lags + 1)
+    bound = (norm.ppf(1 - alpha / 2) / np.sqrt(n))[:, None]
+    # a NaN autocorrelation counts as significant and makes the variance NaN, as in pymannkendall
+    counted = ~((acf <= bound) & (acf >= -bound)) & (k < n[:, None])
+    nk = n[:, None] - k
+    sni = np.sum(np.where(counted, nk * (nk - 1) * (nk - 2) * acf, 0.0), axis=1)
+    return 1 + 2 / (n * (n - 1) * (n - 2)) * sni
+
+
+def pre_whiten(xt, n, slope):
+    # Yue and Wang (2002) trend-free pre-whitening: remove the Sen trend, take out the lag-1
+    # autocorrelation, put the trend back. Returns compacted rows one value shorter.
+    packed = compact(xt)
+    detrended = packed - np.arange(1, xt.shape[1] + 1) * slope[:, None]
+    r1 = autocorrelation(detrended, n, 1)[:, 1:]
+    whitened = detrended[:, 1:] - detrended[:, :-1] * r1
+    return whitened + np.arange(1, xt.shape[1]) * slope[:, None]
+
+
+def mk_block(x, alpha=0.05, method="original", lag=None):
+    # x is a (time, cell) float array, or (season, time, cell) for method "seasonal"; returns a
+    # dict of (cell,) arrays. Cells too short for the method (MK_MIN_YEARS) get NaN statistics
+    # and TREND_NONE.
+    if method not in MK_METHODS:
+        raise ValueError(f"Unknown Mann-Kendall method {method!r}; expected one of {MK_METHODS}")
+    x = np.asarray(x, dtype=np.float64)
+    seasons = x if method == "seasonal" else x[None]
+    # (season, cell, time): rows are series
+    xt = np.ascontiguousarray(np.swapaxes(seasons, 1, 2))
+    n_season = np.count_nonzero(~np.isnan(xt), axis=2).astype(np.float64)
+    n = n_season.sum(axis=0) if method == "seasonal" else n_season[0]
+    testable = n >= MK_MIN_YEARS[method]
+    xt, n_season, n_t = xt[:, testable], n_season[:, testable], n[testable]
+
+    # Sen's slope over every valid pair of each season at its real spacing
+    s = var_s = pairs = 0.0
+    season_slopes = []
+    for series, count in zip(xt, n_season):
+        diffs, i, j = pair_diffs(series)
+        s = s + mk_score(diffs)
+        var_s = var_s + tie_variance(series, count)
+        pairs = pairs + 0.5 * count * (count - 1)
+        diffs /= j - i
+        season_slopes.append(diffs)
+    slope = sens_slope(season_slopes[0] if len(season_slopes) == 1 else np.concatenate(season_slopes, axis=1))
+    del season_slopes
+
+    if method == "hamed_rao":
+        var_s = var_s * hamed_rao_factor(xt[0], n_t, slope, alpha, lag)
+    elif method == "pre_whitened":
+        whitened = pre_whiten(xt[0], n_t, slope)
+        s = mk_score(pair_diffs(whitened)[0])
+        var_s = tie_variance(whitened, n_t - 1)
+        pairs = 0.5 * (n_t - 1) * (n_t - 2)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = np.where(s > 0, (s - 1) / np.sqrt(var_s), np.where(s < 0, (s + 1) / np.sqrt(var_s), 0.0))
+
+    out = {name: np.full(len(n), np.nan) for name in ("p", "z", "tau", "s", "var_s", "slope")}
+    out["trend"] = np.full(len(n), TREND_NONE, dtype=np.int8)
+    significant = np.abs(z) > norm.ppf(1 - alpha / 2)
+    out["trend"][testable] = np.where(significant, np.sign(z), TREND_NONE)
+    out["p"][testable] = 2 * (1 - norm.cdf(np.abs(z)))
+    out["z"][testable] = z
+    out["tau"][testable] = s / pairs
+    out["s"][testable] = s
+    out["var_s"][testable] = var_s
+    out["slope"][testable] = slope
+    return out
+
+
+def mk_grid(stack, alpha=0.05, chunk=MK_CHUNK, method="original", lag=None):
+    # stack is a (time, ...) array of maps, (season, time, ...) for method "seasonal"; returns a
+    # dict of (...) maps, computed chunk cells at a time
+    stack = np.asarray(stack)
+    lead = 2 if method == "seasonal" else 1
+    spatial = stack.shape[lead:]
+    flat = stack.reshape(stack.shape[:lead] + (-1,))
+    n_cells = flat.shape[-1]
+    out = None
+    for start in range(0, n_cells, chunk):
+        block = mk_block(flat[..., start:start + chunk], alpha, method, lag)
+        if out is None:
+            out = {name: np.empty(n_cells, dtype=value.dtype) for name, value in block.items()}
+        for name, value in block.items():
+            out[name][start:start + chunk] = value
+    return {name: value.reshape(spatial) for name, value in out.items()}
+
+
+def store_grid(paths):
+    # Ascending lat/lon of metrics stores that share a grid, the store indices that give that
+    # order, and the union of their years
+    datasets = [MetricsStore(path).open_dataset() for path in paths]
+    lat, lon = datasets[0]["lat"].values, datasets[0]["lon"].values
+    for path, ds in zip(paths[1:], datasets[1:]):
+        if not (np.allclose(ds["lat"].values, lat) and np.allclose(ds["lon"].values, lon)):
+            raise ValueError(f"{path} holds a different grid from {paths[0]}")
+    lat_index, lon_index = np.argsort(lat, kind="stable"), np.argsort(lon, kind="stable")
+    years = np.unique(np.concatenate([ds["time"].values for ds in datasets]))
+    return lat[lat_index], lon[lon_index], lat_index, lon_index, years
+
+
+def trend_tile(paths, variable, rows, cols, years, method, alpha, lag):
+    # Worker: read one tile of every store (missing years as NaN) and test it. Only the tile's
+    # chunks are read, so a worker never holds more than a tile of the grid.
+    stacks = [MetricsStore(path).open_dataset()[variable].isel(lat=rows, lon=cols)
+              .reindex(time=years).transpose("time", "lat", "lon").values for path in paths]
+    stack = np.stack(stacks) if method == "seasonal" else stacks[0]
+    return mk_grid(stack, alpha, method=method, lag=lag)
+
+
+def mk_tiles(paths, variable, method="original", alpha=0.05, lag=None, workers=None, tile=TREND_TILE):
+    # Test variable of one metrics store (or one store per season for method "seasonal") tile by
+    # tile on a process pool. Yields (lat slice, lon slice, result maps) in the ascending
+    # store_grid order as tiles finish, so callers can write each tile out and drop it.
+    if method != "seasonal" and len(paths) != 1:
+        raise ValueError(f"Method {method!r} tests a single store; got {len(paths)}")
+    _, _, lat_index, lon_index, years = store_grid(paths)
+    tiles = ((slice(a, a + tile), slice(b, b + tile))
+             for a in range(0, len(lat_index), tile) for b in range(0, len(lon_index), tile))
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def submit(rows, cols):
+            return pool.submit(trend_tile, paths, variable, lat_index[rows], lon_index[cols], years,
+                               method, alpha, lag)
+
+        # At most TILES_IN_FLIGHT tiles per worker are queued or finished and not yet consumed;
+        # each finished future is dropped before its maps are handed on
+        futures = {submit(*rows_cols): rows_cols for rows_cols in islice(tiles, TILES_IN_FLIGHT * workers)}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                rows_cols = futures.pop(future)
+                for next_rows_cols in islice(tiles, 1):
+                    futures[submit(*next_rows_cols)] = next_rows_cols
+                yield rows_cols + (future.result(),)
+
+
+if __name__ == "__main__":
+    import time
+    import warnings
+
+    import pymannkendall as mk
+
+    warnings.simplefilter("ignore", RuntimeWarning)
+    rng = np.random.default_rng(0)
+    n_years, n_cells = 36, 2000
+    trend_part = np.linspace(0, 1, n_years)[:, None] * rng.normal(0, 4, n_cells)
+    stack = np.rint(rng.gamma(4, 3, (n_years, n_cells)) + trend_part).astype(np.float32)  # integer-valued, many ties
+    gaps = rng.random(stack.shape) < 0.03
+    gaps[:, 200:] = False  # like PRISM: most land cells have every year, a few have gaps
+    stack[gaps] = np.nan
+    stack[:, 0] = np.nan
+    stack[:-2, 1] = np.nan  # two valid years
+    stack[:, 2] = 7.0  # all tied
+    seasons = np.stack([np.roll(stack, k, axis=1) for k in range(4)])
+
+    references = {
+        "original": mk.original_test,
+        "hamed_rao": mk.hamed_rao_modification_test,
+        "pre_whitened": mk.trend_free_pre_whitening_modification_test,
+        "seasonal": lambda series: mk.seasonal_test(series, period=4),
+    }
+    for method, reference in references.items():
+        data = seasons if method == "seasonal" else stack
+        t0 = time.perf_counter()
+        ours = mk_grid(data, chunk=512, method=method)
+        t_ours = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for c in range(n_cells):
+            series = data[..., c].T.ravel() if method == "seasonal" else data[:, c]
+            if np.count_nonzero(~np.isnan(series)) < MK_MIN_YEARS[method]:
+                assert np.isnan(ours["p"][c]) and ours["trend"][c] == TREND_NONE
+                continue
+            ref = reference(series)
+            assert TREND_LABELS[int(ours["trend"][c])] == ref.trend, (method, c, ours["trend"][c], ref.trend)
+            for name, value in (("s", ref.s), ("var_s", ref.var_s), ("z", ref.z), ("p", ref.p), ("tau", ref.Tau),
+                                ("slope", ref.slope)):
+                assert np.isclose(ours[name][c], value, rtol=1e-9, atol=1e-12, equal_nan=True), \
+                    (method, c, name, ours[name][c], value)
+        t_ref = time.perf_counter() - t0
+        print(f"{method}: {n_cells} cells x {n_years} years match pymannkendall: "
+              f"{t_ref:.2f}s one cell at a time vs {t_ours:.3f}s batched ({t_ref / t_ours:.0f}x)")
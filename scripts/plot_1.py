@@ -3,41 +3,29 @@
 import os
 from pathlib import Path
 import numpy as np
-import xarray as xr
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 
+from grids import to_grid
+from metrics_store import load_metrics
+
 # ---- config
 NC_DIR = Path("nc_output2")
+STORE = NC_DIR / "metrics_water_year.zarr"
 OUT = Path("plots"); OUT.mkdir(exist_ok=True)
 SEG1 = (1990, 2005)
 SEG2 = (2006, 2024)
 CA = dict(lat=slice(32.54, 42.0), lon=slice(-125.0, -113.05))
 VMIN, VMAX = 2.0, 29.0
 
-def load_stack(start, end):
-    files = sorted(NC_DIR.glob("metrics_wy*.nc"))
-    sel = [f for f in files if start <= int(f.stem.split("wy")[-1]) <= end]
-    if not sel:
-        raise RuntimeError(f"No NetCDFs found for {start}–{end}.")
-    ds_list = []
-    for f in sel:
-        yr = int(f.stem.split("wy")[-1])
-        ds = xr.open_dataset(f).assign_coords(time=yr)
-        da = ds["wd50"]
-        if da.lat[0] > da.lat[-1]: da = da.sortby("lat")
-        if da.lon[0] > da.lon[-1]: da = da.sortby("lon")
-        ds_list.append(ds.assign(wd50=da))
-    return xr.concat(ds_list, dim="time")
-
 def per_cell_median(ds):
-    return ds.wd50.sel(**CA).sortby("lat").median("time", skipna=True)
+    return ds.wd50.sel(**CA).median("time", skipna=True)
 
-# ---- load & regrid to a common grid (seg2 -> seg1 grid)
-ds1 = load_stack(*SEG1)                      # reference grid
-ds2 = load_stack(*SEG2)
-ds2_rg = ds2.interp(lat=ds1.wd50.lat, lon=ds1.wd50.lon)
+# ---- load & align to a common grid (seg2 -> seg1 grid; an index selection when both are canonical)
+ds1 = load_metrics(STORE, *SEG1, ["wd50"])   # reference grid
+ds2 = load_metrics(STORE, *SEG2, ["wd50"])
+ds2_rg = to_grid(ds2, ds1.wd50.lat, ds1.wd50.lon)
 
 # ---- per-cell medians over California
 m1 = per_cell_median(ds1)
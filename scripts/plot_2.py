@@ -1,33 +1,17 @@
-import xarray as xr
 from pathlib import Path
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import os
 
+from metrics_store import load_metrics
+
 os.makedirs("plots", exist_ok=True)
 
 nc_dir = Path("nc_output2")
-files = sorted(nc_dir.glob("metrics_wy*.nc"))
-seg2 = [f for f in files if 2006 <= int(f.stem.split("wy")[-1]) <= 2024]
-
-ds_list = []
-for f in seg2:
-    ds = xr.open_dataset(f)
-    year = int(f.stem.split("wy")[-1])
-    ds = ds.assign_coords(time=year)
-    ds_list.append(ds)
-
-combined = xr.concat(ds_list, dim="time")
+combined = load_metrics(nc_dir / "metrics_water_year.zarr", 2006, 2024, ["wd50"])  # ascending lat/lon
 median_wd50 = combined["wd50"].median(dim="time")
-
-if median_wd50.lat[0] < median_wd50.lat[-1]:
-    median_wd50 = median_wd50.sel(lat=slice(32.54, 42.0), lon=slice(-125.0, -113.05))
-else:
-    median_wd50 = median_wd50.sel(lat=slice(42.0, 32.54), lon=slice(-125.0, -113.05))
-
-
-median_wd50 = median_wd50.sortby('lat')
+median_wd50 = median_wd50.sel(lat=slice(32.54, 42.0), lon=slice(-125.0, -113.05))
 
 # Plot using imshow with enhanced contrast
 fig, ax = plt.subplots(figsize=(7, 6), subplot_kw={'projection': ccrs.PlateCarree()})
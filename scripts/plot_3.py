@@ -1,40 +1,28 @@
 import os
 from pathlib import Path
 import numpy as np
-import xarray as xr
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 
+from grids import to_grid
+from metrics_store import load_metrics
+
 os.makedirs("plots", exist_ok=True)
 
 NC_DIR = Path("nc_output2")
+STORE = NC_DIR / "metrics_water_year.zarr"
 CA = dict(lat=slice(32.54, 42.0), lon=slice(-125.0, -113.05))
 SEG1 = (1990, 2005)
 SEG2 = (2006, 2024)
 
-def load_stack(start, end):
-    files = sorted(NC_DIR.glob("metrics_wy*.nc"))
-    sel = [f for f in files if start <= int(f.stem.split("wy")[-1]) <= end]
-    if not sel:
-        raise RuntimeError(f"No files for {start}–{end}")
-    ds_list = []
-    for f in sel:
-        yr = int(f.stem.split("wy")[-1])
-        ds = xr.open_dataset(f).assign_coords(time=yr)
-        da = ds["wd50"]
-        if da.lat[0] > da.lat[-1]: da = da.sortby("lat")
-        if da.lon[0] > da.lon[-1]: da = da.sortby("lon")
-        ds_list.append(ds.assign(wd50=da))
-    return xr.concat(ds_list, dim="time")
-
 def median_CA(ds):
-    return ds.wd50.sel(**CA).sortby("lat").median("time", skipna=True)
+    return ds.wd50.sel(**CA).median("time", skipna=True)
 
 # 1) Load both segments; regrid SEG2 to SEG1’s grid BEFORE computing medians
-ds1 = load_stack(*SEG1)                                  # reference grid
-ds2 = load_stack(*SEG2).interp(lat=ds1.wd50.lat, lon=ds1.wd50.lon)
+ds1 = load_metrics(STORE, *SEG1, ["wd50"])               # reference grid
+ds2 = to_grid(load_metrics(STORE, *SEG2, ["wd50"]), ds1.wd50.lat, ds1.wd50.lon)
 
 m1 = median_CA(ds1)                                      # 1990–2005 median
 m2 = median_CA(ds2)                                      # 2006–2024 median
@@ -0,0 +1,133 @@
+"""Persistent content-addressed cache of raw PRISM daily zips.
+
+Blobs live under <root>/objects/<sha[:2]>/<sha>.zip and a small sqlite index
+maps (variable, resolution, stability, date) keys to them. The index also tracks
+last use so the cache can be held under a byte budget with LRU eviction.
+Every hit is re-hashed before it is returned; a corrupt blob is dropped and
+treated as a miss so the caller simply downloads the day again. Run this file
+directly to check eviction and checksum handling.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+def cache_key(variable, resolution, date, stability):
+    return f"{variable}/{resolution}/{stability}/{date.strftime('%Y%m%d')}"
+
+
+class PrismCache:
+    def __init__(self, root, max_bytes=50 * 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=60, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _blob_path(self, sha):
+        return os.path.join(self.root, "objects", sha[:2], f"{sha}.zip")
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT sha256 FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            sha = row[0]
+            try:
+                with open(self._blob_path(sha), "rb") as f:
+                    content = f.read()
+            except FileNotFoundError:
+                content = None
+            if content is None or hashlib.sha256(content).hexdigest() != sha:
+                print(f"Cache entry {key} failed checksum, discarding")
+                self._remove(key, sha)
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return content
+
+    def put(self, key, content):
+        sha = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(sha)
+        with self._lock:
+            if not os.path.exists(path):
+                # Write to a temp file first so a crash never leaves a truncated blob behind
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # (named per process and thread rather than by mkstemp, which creates files owner-only)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+                with open(tmp_path, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            row = self._db.execute("SELECT sha256 FROM entries WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, sha256, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, sha, len(content), time.time()),
+            )
+            if row is not None and row[0] != sha:
+                self._delete_blob_if_unused(row[0])
+            self._evict()
+            self._db.commit()
+
+    def total_bytes(self):
+        with self._lock:
+            return self._total_bytes()
+
+    def _total_bytes(self):
+        # Blobs are content-addressed, so count each distinct blob once
+        row = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM entries)").fetchone()
+        return row[0]
+
+    def _remove(self, key, sha):
+        self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._delete_blob_if_unused(sha)
+
+    def _delete_blob_if_unused(self, sha):
+        if self._db.execute("SELECT 1 FROM entries WHERE sha256 = ? LIMIT 1", (sha,)).fetchone() is None:
+            try:
+                os.remove(self._blob_path(sha))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        total = self._total_bytes()
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute("SELECT key, sha256, size FROM entries ORDER BY last_used ASC").fetchall()
+        for key, sha, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._remove(key, sha)
+            if self._db.execute("SELECT 1 FROM entries WHERE sha256 = ? LIMIT 1", (sha,)).fetchone() is None:
+                total -= size
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    cache = PrismCache(tempfile.mkdtemp(), max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    cache.put("b2", b"bbbb")  # same content: one blob, counted once
+    assert cache.total_bytes() == 8
+    assert cache.get("a") == b"aaaa"  # a is now more recently used than b
+    cache.put("c", b"cccc")  # 12 bytes > 10: the least recently used blob goes
+    assert cache.get("b") is None and cache.get("b2") is None
+    assert cache.get("a") == b"aaaa" and cache.get("c") == b"cccc" and cache.total_bytes() == 8
+
+    with open(cache._blob_path(hashlib.sha256(b"cccc").hexdigest()), "wb") as f:
+        f.write(b"cccX")  # corrupt on disk: dropped and reported as a miss
+    assert cache.get("c") is None and cache.total_bytes() == 4
+    cache.close()
+    print("LRU eviction, shared blobs and checksum failures check out")
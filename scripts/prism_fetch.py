@@ -0,0 +1,238 @@
+"""Concurrent PRISM daily downloader.
+
+One keep-alive requests.Session is shared by a bounded thread pool, so a water
+year is fetched with `max_workers` requests in flight instead of one blocking
+round trip per day. Results are always handed back in date order. When a
+PrismCache is attached, cached days are served from disk without touching the
+network and fresh downloads are stored for the next run once they have been
+checked to be complete zips.
+
+PRISM publishes each day as "early", then "provisional", and finally "stable"
+(about six months later). A fetch is given the stabilities to try in order and
+returns the first one PRISM has.
+
+Run this file directly to check the fetcher against a local stand-in HTTP
+server (prism_base_url points the pipeline at one the same way).
+"""
+import io
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from daily_archive import STATUS_EARLY, STATUS_NOT_FOUND, STATUS_PROVISIONAL, STATUS_STABLE
+from prism_cache import cache_key
+from windows import WINDOWS, window_dates
+
+PRISM_BASE_URL = "https://ftp.prism.oregonstate.edu/daily"
+PRISM_RESOLUTION = "4kmD2"
+STABILITY_ORDER = ("stable", "provisional", "early")
+STABLE_LAG_DAYS = 200  # PRISM replaces provisional days with stable ones about six months after the day
+
+
+def prism_filename(variable, date, stability="stable"):
+    return f"PRISM_{variable}_{stability}_{PRISM_RESOLUTION}_{date.strftime('%Y%m%d')}_bil"
+
+
+def prism_url(variable, date, stability="stable", base_url=PRISM_BASE_URL):
+    return f"{base_url}/{variable}/{date.year}/{prism_filename(variable, date, stability)}.zip"
+
+
+def water_year_dates(wy):
+    # Oct 1 of the previous calendar year through Sep 30
+    return window_dates(WINDOWS["water_year"], wy)
+
+
+def make_session(max_workers):
+    # Size the connection pool to the worker count so every thread reuses a live connection
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def settled(date, today=None):
+    # True once PRISM has had time to publish the stable version of date; a day it still lacks
+    # by then is taken as never published
+    today = today or datetime.now()
+    return (today.date() - date.date()).days > STABLE_LAG_DAYS
+
+
+def refresh_plan(status, dates, today=None):
+    # (day indices, stabilities to try) among the published dates of a year whose archive status
+    # is given: stable days are done, provisional/early ones only try better versions, and days
+    # PRISM answered with a 404 are retried until they are settled
+    todo, tries = [], []
+    for i, date in enumerate(dates):
+        if status[i] == STATUS_STABLE or (status[i] == STATUS_NOT_FOUND and settled(date, today)):
+            continue
+        todo.append(i)
+        if status[i] == STATUS_PROVISIONAL:
+            tries.append(("stable",))
+        elif status[i] == STATUS_EARLY:
+            tries.append(("stable", "provisional"))
+        else:
+            tries.append(STABILITY_ORDER)
+    return todo, tries
+
+
+class PrismFetcher:
+    def __init__(self, variable="ppt", max_workers=8, base_url=PRISM_BASE_URL,
+                 stabilities=STABILITY_ORDER, timeout=120, cache=None):
+        if max_workers < 1:
+            raise ValueError("max_workers must be >= 1")
+        self.variable = variable
+        self.max_workers = max_workers
+        self.base_url = base_url
+        self.stabilities = tuple(stabilities)
+        self.timeout = timeout
+        self.cache = cache
+        self.session = make_session(max_workers)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prism-fetch")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.session.close()
+
+    def fetch(self, date, stabilities=None):
+        # Returns (zip bytes, stability) for the first stability PRISM has, or (None, None) if every
+        # one is a 404; any other HTTP error or a network failure raises
+        for stability in stabilities or self.stabilities:
+            content = self._fetch_one(date, stability)
+            if content is not None:
+                return content, stability
+        return None, None
+
+    def _fetch_one(self, date, stability):
+        key = cache_key(self.variable, PRISM_RESOLUTION, date, stability)
+        if self.cache is not None:
+            content = self.cache.get(key)
+            if content is not None:
+                return content
+        url = prism_url(self.variable, date, stability, self.base_url)
+        r = self.session.get(url, timeout=self.timeout)
+        if r.status_code == 404:
+            return None  # PRISM does not have this version of the day (yet)
+        r.raise_for_status()  # throttling and server errors are failures to retry, not missing days
+        # A truncated or corrupt download fails the day instead of being cached for every later run
+        with zipfile.ZipFile(io.BytesIO(r.content)) as archive:
+            if archive.testzip() is not None:
+                raise zipfile.BadZipFile(f"Corrupt member in {url}")
+        if self.cache is not None:
+            self.cache.put(key, r.content)
+        return r.content
+
+    def submit(self, dates, stabilities=None):
+        # stabilities applies to every date, or pass a list with one tuple per date
+        if stabilities is None or isinstance(stabilities[0], str):
+            stabilities = [stabilities] * len(dates)
+        return [(date, self.pool.submit(self.fetch, date, s)) for date, s in zip(dates, stabilities)]
+
+    @staticmethod
+    def iter_ordered(pending):
+        # Yield (date, future) in date order; future.result() re-raises download errors per day.
+        # pending is emptied as it goes, so each day's download is freed once the caller moves on
+        # instead of the whole year's zips staying referenced until it is done
+        pending.sort(key=lambda item: item[0], reverse=True)
+        while pending:
+            yield pending.pop()
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    from datetime import timedelta
+    from functools import partial
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+    from threading import Thread
+
+    from prism_cache import PrismCache
+
+    requested = []
+    failing = set()  # paths answered with 503 once
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            if self.path in failing:
+                failing.discard(self.path)
+                self.send_error(503)
+                return
+            super().do_GET()
+
+        def log_message(self, *args):
+            requested.append(self.path)
+
+    root = tempfile.mkdtemp()
+    dates = water_year_dates(2012)[:5]
+
+    def publish(date, stability):
+        path = os.path.join(root, "ppt", str(date.year), prism_filename("ppt", date, stability) + ".zip")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.writestr("day.txt", f"{stability} {date:%Y%m%d}")
+
+    for date in dates[:3]:
+        publish(date, "stable")
+    publish(dates[3], "provisional")  # dates[4] is not published at all
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=root))
+    Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    cache = PrismCache(os.path.join(root, "cache"))
+    with PrismFetcher("ppt", max_workers=3, base_url=base_url, cache=cache) as fetcher:
+        # Full ingest: every stability in order, results handed back in date order
+        pending = fetcher.submit(dates[::-1])
+        got = [(date, future.result()) for date, future in fetcher.iter_ordered(pending)]
+        assert [date for date, _ in got] == dates and not pending
+        assert [result[1] for _, result in got] == ["stable"] * 3 + ["provisional", None]
+        with zipfile.ZipFile(io.BytesIO(got[0][1][0])) as archive:
+            assert archive.read("day.txt") == f"stable {dates[0]:%Y%m%d}".encode()
+
+        # Refresh: only the provisional and missing days are queued, the provisional one for stable only
+        status = [STATUS_STABLE] * 3 + [STATUS_PROVISIONAL, STATUS_NOT_FOUND]
+        just_after = dates[-1] + timedelta(days=1)  # the 404 may only mean "not published yet"
+        todo, tries = refresh_plan(status, dates, today=just_after)
+        assert todo == [3, 4] and tries == [("stable",), STABILITY_ORDER]
+        assert refresh_plan(status, dates, today=just_after + timedelta(days=STABLE_LAG_DAYS))[0] == [3]
+        assert refresh_plan([STATUS_EARLY], dates[:1])[1] == [("stable", "provisional")]
+        refresh = [future.result() for _, future in fetcher.submit([dates[i] for i in todo], tries)]
+        assert refresh == [(None, None), (None, None)]
+        publish(dates[3], "stable")  # the provisional day upgrades once stable is out
+        assert fetcher.submit([dates[3]], [tries[0]])[0][1].result()[1] == "stable"
+
+        # A server error is raised, not reported as a missing day, and the retry succeeds
+        failing.add(f"/ppt/{dates[1].year}/{prism_filename('ppt', dates[1], 'provisional')}.zip")
+        try:
+            fetcher.fetch(dates[1], ("provisional",))
+            raise AssertionError("a 503 must raise")
+        except requests.HTTPError:
+            pass
+        assert fetcher.fetch(dates[1], ("provisional", "stable"))[1] == "stable"
+
+        # A truncated zip is raised and kept out of the cache
+        publish(dates[4], "stable")
+        path = os.path.join(root, "ppt", str(dates[4].year), prism_filename("ppt", dates[4], "stable") + ".zip")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) // 2)
+        try:
+            fetcher.fetch(dates[4], ("stable",))
+            raise AssertionError("a truncated zip must raise")
+        except zipfile.BadZipFile:
+            pass
+        assert cache.get(cache_key("ppt", PRISM_RESOLUTION, dates[4], "stable")) is None
+
+        # Cached days never go back to the server
+        n_requests = len(requested)
+        assert all(future.result()[1] == "stable" for _, future in fetcher.submit(dates[:4], [("stable",)] * 4))
+        assert len(requested) == n_requests, requested[n_requests:]
+    server.shutdown()
+    print(f"fetched {len(dates)} days from a local server in date order; refresh plans, upgrades, corrupt zips and cache hits check out")
@@ -0,0 +1,73 @@
+"""Decode PRISM daily .bil rasters straight from the downloaded zip bytes.
+
+rasterio's ZipMemoryFile exposes the archive through GDAL's /vsizip/ and
+/vsimem/ handlers, so nothing is extracted or written to disk. An optional
+region of interest is turned into a read window so only the cells whose
+centres fall inside the bounding box are ever decoded.
+"""
+import numpy as np
+from rasterio.io import ZipMemoryFile
+from rasterio.windows import Window
+
+from prism_fetch import prism_filename
+
+PRISM_NODATA = -9999
+
+# PRISM 4 km CONUS daily grid: 621 rows x 1405 cols of 1/24 degree cells (left, bottom, right, top)
+PRISM_CONUS_BOUNDS = (-125.0208333, 24.0625, -66.4791667, 49.9375)
+PRISM_CONUS_SHAPE = (621, 1405)
+
+
+def grid_from_bounds(left, bottom, right, top, height, width):
+    # Cell-centre lat/lon vectors (lat runs north to south)
+    lat_res = (top - bottom) / height
+    lon_res = (right - left) / width
+    lat_grid = np.linspace(top - 0.5 * lat_res, bottom + 0.5 * lat_res, height)
+    lon_grid = np.linspace(left + 0.5 * lon_res, right - 0.5 * lon_res, width)
+    return lat_grid, lon_grid
+
+
+def grid_from_src(src):
+    bounds = src.bounds
+    return grid_from_bounds(bounds.left, bounds.bottom, bounds.right, bounds.top, src.height, src.width)
+
+
+def expected_shape(region=None):
+    # (lat, lon) shape of the daily grid before anything is downloaded, for memory planning
+    if region is None:
+        return PRISM_CONUS_SHAPE
+    lat_grid, lon_grid = grid_from_bounds(*PRISM_CONUS_BOUNDS, *PRISM_CONUS_SHAPE)
+    window = region_window(lat_grid, lon_grid, region)
+    return int(window.height), int(window.width)
+
+
+def region_window(lat_grid, lon_grid, region):
+    # region is dict(lat=(south, north), lon=(west, east)), same bounds the plot scripts slice with
+    lat_min, lat_max = sorted(region["lat"])
+    lon_min, lon_max = sorted(region["lon"])
+    rows = np.flatnonzero((lat_grid >= lat_min) & (lat_grid <= lat_max))
+    cols = np.flatnonzero((lon_grid >= lon_min) & (lon_grid <= lon_max))
+    if rows.size == 0 or cols.size == 0:
+        raise ValueError(f"Region {region} does not overlap the PRISM grid")
+    return Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+
+
+def read_prism_day(content, variable, date, stability="stable", region=None, out=None):
+    # Returns (float32 array with NaN for no-data, lat_grid, lon_grid), cropped to region if given.
+    # Pass a float32 slice of a preallocated cube as `out` to decode straight into it.
+    bil_name = f"{prism_filename(variable, date, stability)}.bil"
+    with ZipMemoryFile(content) as zmf:
+        with zmf.open(bil_name) as src:
+            lat_grid, lon_grid = grid_from_src(src)
+            window = None
+            if region is not None:
+                window = region_window(lat_grid, lon_grid, region)
+                rows, cols = window.toslices()
+                lat_grid, lon_grid = lat_grid[rows], lon_grid[cols]
+            if out is None:
+                data = src.read(1, window=window).astype(np.float32)
+            else:
+                src.read(1, window=window, out=out, out_dtype=np.float32)
+                data = out
+            data[data == PRISM_NODATA] = np.nan
+    return data, lat_grid, lon_grid
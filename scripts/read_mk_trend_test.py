@@ -1,8 +1,10 @@
 import xarray as xr
 import numpy as np
 
-# Load the output file
-ds = xr.open_dataset("wd50_mk_trend.nc")
+from mk_trend import TREND_DECREASING, TREND_INCREASING, TREND_LABELS
+
+# Load the output file; trend stays as its int8 codes (mk_trend.TREND_*)
+ds = xr.open_dataset("wd50_mk_trend.nc", mask_and_scale=False)
 
 # Access individual variables
 trend = ds["trend"]
@@ -11,7 +13,9 @@ slope = ds["slope"]
 
 # Basic overview
 print("WD50 Mann-Kendall Trend Results:")
-print(f"- Trend categories: {np.unique(trend.values)}")
+codes, counts = np.unique(trend.values, return_counts=True)
+print("- Trend categories: " + ", ".join(f"{TREND_LABELS.get(code, 'untested')} {count}"
+                                         for code, count in zip(codes, counts)))
 print(f"- P-value range: {np.nanmin(p_value.values):.4f} to {np.nanmax(p_value.values):.4f}")
 print(f"- Slope range: {np.nanmin(slope.values):.4f} to {np.nanmax(slope.values):.4f}")
 
@@ -22,7 +26,7 @@ total_cells = np.count_nonzero(~np.isnan(p_value.values))
 print(f"- Significant trends (p < 0.05): {num_sig} of {total_cells} cells")
 
 # Optional: count how many are increasing vs decreasing
-increasing = ((trend == "increasing") & sig_mask).sum().item()
-decreasing = ((trend == "decreasing") & sig_mask).sum().item()
+increasing = ((trend == TREND_INCREASING) & sig_mask).sum().item()
+decreasing = ((trend == TREND_DECREASING) & sig_mask).sum().item()
 print(f"- Increasing (sig): {increasing}")
 print(f"- Decreasing (sig): {decreasing}")
@@ -0,0 +1,43 @@
+"""Daily precipitation held as scaled uint16 codes.
+
+A code is the amount in hundredths of a millimetre, so one value takes two
+bytes instead of four. PPT_FILL marks missing data (NaN), and amounts above
+PPT_MAX_MM (655.34 mm) saturate; the ingest loop reports any day that hits it.
+Decoding divides by 100 in float32, so values with two decimals round-trip
+exactly and anything finer is rounded to the nearest 0.01 mm.
+"""
+import numpy as np
+
+PPT_DTYPE = np.uint16
+PPT_SCALE = 0.01  # mm per code
+PPT_FILL = np.iinfo(PPT_DTYPE).max
+PPT_MAX_MM = (PPT_FILL - 1) * PPT_SCALE
+
+
+def encode_ppt(values, out=None):
+    # float mm (NaN = missing) -> uint16 codes; negative amounts clip to 0, large ones saturate
+    values = np.asarray(values, dtype=np.float32)
+    codes = np.rint(values * np.float32(1 / PPT_SCALE))
+    np.clip(codes, 0, PPT_FILL - 1, out=codes)
+    codes[np.isnan(values)] = PPT_FILL
+    if out is None:
+        return codes.astype(PPT_DTYPE)
+    np.copyto(out, codes, casting="unsafe")
+    return out
+
+
+def decode_ppt(codes, out=None):
+    # uint16 codes -> float32 mm with NaN where missing
+    codes = np.asarray(codes)
+    values = np.divide(codes, np.float32(1 / PPT_SCALE), out=out, dtype=np.float32)
+    values[codes == PPT_FILL] = np.nan
+    return values
+
+
+if __name__ == "__main__":
+    mm = np.array([0.0, 0.01, 1.0, 12.34, 254.0, np.nan, -0.5, 1000.0], dtype=np.float32)
+    codes = encode_ppt(mm)
+    assert codes.tolist() == [0, 1, 100, 1234, 25400, PPT_FILL, 0, PPT_FILL - 1], codes
+    back = decode_ppt(codes)
+    assert np.array_equal(back[:6], mm[:6], equal_nan=True), back
+    print("scaled ppt codes round-trip two-decimal values")
@@ -0,0 +1,50 @@
+"""Packed representation of the grid cells that hold data.
+
+About half of the PRISM CONUS grid is no-data (ocean, Canada, Mexico) and the
+mask is the same every day. A CellIndex keeps the flat (lat, lon) indices of
+the valid cells, so daily cubes can be held as (time, cell) arrays of land
+cells only. Memory and metric work then scale with land area instead of the
+bounding box, and results are scattered back to (lat, lon) only when they are
+written or plotted.
+"""
+import numpy as np
+
+
+class CellIndex:
+    def __init__(self, lat_grid, lon_grid, cells):
+        self.lat = np.asarray(lat_grid)
+        self.lon = np.asarray(lon_grid)
+        self.cells = np.asarray(cells, dtype=np.int64)
+
+    @classmethod
+    def from_mask(cls, lat_grid, lon_grid, valid):
+        return cls(lat_grid, lon_grid, np.flatnonzero(valid))
+
+    @property
+    def grid_shape(self):
+        return len(self.lat), len(self.lon)
+
+    @property
+    def n_cells(self):
+        return len(self.cells)
+
+    def __eq__(self, other):
+        return (isinstance(other, CellIndex) and self.grid_shape == other.grid_shape
+                and np.allclose(self.lat, other.lat) and np.allclose(self.lon, other.lon)
+                and np.array_equal(self.cells, other.cells))
+
+    def pack(self, grid, out=None):
+        # (..., lat, lon) -> (..., cell); out may be a preallocated (..., cell) array such as a cube row
+        flat = np.asarray(grid).reshape(np.shape(grid)[:-2] + (-1,))
+        return np.take(flat, self.cells, axis=-1, out=out)
+
+    def scatter(self, packed, fill=np.nan):
+        # (..., cell) -> (..., lat, lon) with fill in cells outside the index; fill may be an
+        # array broadcasting against packed[..., 0], e.g. per-fraction no-data values
+        packed = np.asarray(packed)
+        fill = np.asarray(fill)
+        dtype = np.result_type(packed.dtype, fill.dtype)
+        out = np.empty(packed.shape[:-1] + (self.grid_shape[0] * self.grid_shape[1],), dtype=dtype)
+        out[...] = fill[..., None] if fill.ndim else fill
+        out[..., self.cells] = packed
+        return out.reshape(packed.shape[:-1] + self.grid_shape)
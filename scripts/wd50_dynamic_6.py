@@ -1,134 +1,580 @@
+import hashlib
+import json
 import os
-import requests
-import zipfile
-import rasterio
 import numpy as np
 import time
-from datetime import datetime, timedelta
-import shutil
 import xarray as xr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from base_quantiles import archive_percentile
+from checkpoint import YearCheckpoint
+from daily_archive import (DailyArchive, STATUS_CODES, STATUS_EARLY, STATUS_MISSING, STATUS_NOT_FOUND,
+                           STATUS_PROVISIONAL, STATUS_STABLE)
+from grids import CANONICAL_GRID, snap_dataset
+from metrics_io import output_attrs, write_netcdf_atomic
+from metrics_store import MetricsStore
+from prism_cache import PrismCache
+from prism_fetch import PrismFetcher, PRISM_BASE_URL, STABILITY_ORDER, refresh_plan, settled, water_year_dates
+from prism_read import expected_shape, read_prism_day
+from scaled_ppt import PPT_DTYPE, PPT_FILL, PPT_MAX_MM, decode_ppt, encode_ppt
+from valid_cells import CellIndex
+from metric_registry import METRICS, compute_metrics, compute_metrics_tiled, metric_attrs
+from wd50_metrics import WET_DAY_THRESHOLD_MM
+from windows import WINDOWS, day_bounds, window_span
 
 # === CONFIGURATION ===
 start_water_year = 2012
 end_water_year = 2025  # inclusive
 variable = "ppt"
-output_dir = "temp_prism"
 nc_output_dir = "nc_output2"
+download_workers = 8  # concurrent PRISM requests (shared keep-alive session)
+prism_base_url = PRISM_BASE_URL  # point at a local server for testing
+cache_dir = "prism_cache"  # raw daily zips are kept here across runs
+cache_max_gb = 50  # least recently used days are evicted beyond this
+region = dict(lat=(32.54, 42.0), lon=(-125.0, -113.05))  # California; None keeps full CONUS
+water_year_workers = 4  # water years processed at once, each in its own process
+memory_budget_gb = 32  # caps water_year_workers so concurrent cubes fit in RAM
+metric_threads = None  # tile threads per water year; None shares the cores among the years running at once
+metric_tile = (32, 128)  # (lat, lon) cells per metric tile
+output_chunks = (128, 128)  # (lat, lon) NetCDF chunk of every exported metric map
+output_grid = CANONICAL_GRID  # registered grid (grids.py) outputs are snapped to; None keeps the read grid
+export_year_files = False  # also write each year's maps to its own NetCDF (metrics_wy{year}.nc)
+checkpoint_dir = "checkpoints"  # memory-mapped scratch cubes of water years still being ingested
+checkpoint_every = 10  # days between checkpoint saves
+overwrite_existing = False  # True recomputes water years whose outputs are already current
+daily_archive_path = "prism_daily_ppt.zarr"  # raw daily cube shared by every metric run; None disables
+incremental = True  # with an archive, only fetch new days and stable replacements of provisional/early ones
+metric_names = ("wd50", "prcptot", "r95p", "r95ptot", "r95ptot_frac", "wdxx", "sdii", "cdd", "cwd",
+                "rx1day", "rxnday", "event_wd50", "n_events")  # any registered in metric_registry.py
+rx_days = 5  # window of the rxnday metric (ETCCDI Rx5day at 5), recorded in its attrs
+wdxx_fractions = (0.25, 0.5, 0.75, 0.9)  # WDxx: wettest days contributing each fraction of PRCPTOT
+wdxx_thresholds = (WET_DAY_THRESHOLD_MM,)  # wet-day thresholds (mm) the WDxx family is computed at
+season_windows = ("calendar_year", "djf", "nov_mar")  # extra windows (windows.py) computed from the daily archive
+r95_base_period = None  # e.g. (1991, 2020): calendar years whose wet days set one fixed R95 threshold map
+                        # (ETCCDI style); those years must already be in the daily archive. None uses
+                        # each window's own 95th percentile
 
-os.makedirs(nc_output_dir, exist_ok=True)
-
-def calculate_wd50(series):
-    # Filters out <1.0 mm and calculates number of wettest days contributing 50% of yearly precip
-    series = series[~np.isnan(series)]
-    wet_days = series[series >= 1.0]
-    if len(wet_days) == 0:
-        return np.nan
-    sorted_daily = np.sort(wet_days)[::-1]
-    cumulative = np.cumsum(sorted_daily)
-    half_total = cumulative[-1] / 2
-    wd50 = np.sum(cumulative < half_total) + 1
-    return wd50
-
-for wy in range(start_water_year, end_water_year + 1):
-    start_date = datetime(wy - 1, 10, 1)
-    end_date = datetime(wy, 9, 30)
-    print(f"\nProcessing Water Year {wy} ({start_date.date()} to {end_date.date()})")
-
-    daily_stack = []
-    lat_grid, lon_grid = None, None
-
-    current = start_date
-    while current <= end_date:
-        date_str = current.strftime("%Y%m%d")
-        year = current.year
-        url = f"https://ftp.prism.oregonstate.edu/daily/{variable}/{year}/PRISM_{variable}_stable_4kmD2_{date_str}_bil.zip"
+# Bump whenever a change to ingest or metric code changes the numbers in the outputs
+PIPELINE_VERSION = "6.4"
 
-        if os.path.exists(output_dir):
-            shutil.rmtree(output_dir)
-        os.makedirs(output_dir, exist_ok=True)
+# Peak memory of one water year relative to its uint16 cube (cube + per-tile decode/sort temporaries)
+PEAK_CUBE_FACTOR = 1.5
 
-        try:
-            print(f"Fetching {date_str}...")
-            t0 = time.time()
+concurrent_years = 1  # water years sharing the cores with this process; set in each pool worker
 
-            r = requests.get(url)
-            if r.status_code != 200:
-                print(f"Not found: {date_str}")
-                current += timedelta(days=1)
-                continue
 
-            zip_path = os.path.join(output_dir, f"{variable}_{date_str}.zip")
-            with open(zip_path, 'wb') as f:
-                f.write(r.content)
+def make_fetcher():
+    cache = PrismCache(cache_dir, max_bytes=int(cache_max_gb * 1024**3))
+    fetcher = PrismFetcher(variable, max_workers=download_workers, base_url=prism_base_url, cache=cache)
+    return fetcher, cache
+
+
+def ingest_config_hash():
+    # Identifies everything that shapes the raw daily cube; a matching checkpoint can be resumed
+    config = {
+        "version": PIPELINE_VERSION,
+        "variable": variable,
+        "region": region,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def daily_archive():
+    # The shared daily archive (None when disabled); one ingested with other settings is refused
+    return DailyArchive(daily_archive_path, ingest_config_hash()) if daily_archive_path else None
+
+
+def run_config_hash():
+    # Identifies everything that shapes the outputs; a matching output can be reused
+    config = {
+        "ingest": ingest_config_hash(),
+        "metrics": list(metric_names),
+        "rx_days": rx_days,
+        "wdxx_fractions": list(wdxx_fractions),
+        "wdxx_thresholds": list(wdxx_thresholds),
+        "r95_base_period": list(r95_base_period) if r95_base_period else None,
+        "output_grid": output_grid,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def r95_base_path():
+    first, last = r95_base_period
+    return os.path.join(nc_output_dir, f"r95_base_{first}_{last}.nc")
+
+
+@lru_cache(maxsize=None)
+def r95_base_map():
+    # The base-period threshold map, built once from the daily archive and reused by every window
+    # and process; None when r95_base_period is unset
+    if not r95_base_period:
+        return None
+    path = r95_base_path()
+    if r95_base_current():
+        with xr.open_dataset(path) as ds:
+            return ds["r95_threshold"].values
+    return build_r95_base_map(path)
+
+
+def r95_base_current():
+    attrs = output_attrs(r95_base_path())
+    return attrs is not None and attrs.get("config_hash") == ingest_config_hash()
+
 
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(output_dir)
+def build_r95_base_map(path):
+    first, last = r95_base_period
+    first_date = datetime(first, 1, 1)
+    n_days = (datetime(last + 1, 1, 1) - first_date).days
+    archive = daily_archive()
+    if archive is None or not archive.exists() or not archive.covers(first_date, n_days):
+        raise ValueError(f"r95_base_period {first}-{last} is not fully in the daily archive; "
+                         f"ingest those water years first")
+    print(f"Building R95 base-period threshold map for {first}-{last} ({n_days} days)")
+    t0 = time.perf_counter()
+    threshold = archive_percentile(archive, first_date, n_days, 95, WET_DAY_THRESHOLD_MM,
+                                   workers=tile_threads())
+    lat_grid, lon_grid = archive.grid()
+    ds = xr.Dataset(
+        {"r95_threshold": (("lat", "lon"), threshold,
+                           {"units": "mm", "long_name": f"95th percentile of wet days, {first}-{last}"})},
+        coords={"lat": lat_grid, "lon": lon_grid},
+        attrs={
+            "base_period": f"{first}-{last}",
+            "wet_day_threshold_mm": WET_DAY_THRESHOLD_MM,
+            "config_hash": ingest_config_hash(),
+            "pipeline_version": PIPELINE_VERSION,
+        },
+    )
+    write_netcdf_atomic(ds, path, encoding={"r95_threshold": {"zlib": True, "complevel": 4}})
+    print(f"Saved {path} in {time.perf_counter() - t0:.1f}s")
+    return threshold
 
-            bil_name = f"PRISM_{variable}_stable_4kmD2_{date_str}_bil.bil"
-            bil_path = os.path.join(output_dir, bil_name)
 
-            with rasterio.open(bil_path) as src:
-                data = src.read(1).astype(np.float32)
-                data[data == -9999] = np.nan
+def metrics_store_path(window="water_year"):
+    # Every year of a window lives in one (time, lat, lon) store, see metrics_store.py
+    return os.path.join(nc_output_dir, f"metrics_{window}.zarr")
 
-                if lat_grid is None or lon_grid is None:
-                    bounds = src.bounds
-                    lat_res = (bounds.top - bounds.bottom) / src.height
-                    lon_res = (bounds.right - bounds.left) / src.width
-                    lat_grid = np.linspace(bounds.top - 0.5 * lat_res, bounds.bottom + 0.5 * lat_res, src.height)
-                    lon_grid = np.linspace(bounds.left + 0.5 * lon_res, bounds.right - 0.5 * lon_res, src.width)
 
-                daily_stack.append(data)
+def output_path(year, window="water_year"):
+    if window == "water_year":
+        return os.path.join(nc_output_dir, f"metrics_wy{year}.nc")
+    return os.path.join(nc_output_dir, f"metrics_{window}_{year}.nc")
+
+
+def window_label(year, window="water_year"):
+    return f"Water Year {year}" if window == "water_year" else f"{window} {year}"
+
+
+def window_finished(year, window="water_year"):
+    return window_span(WINDOWS[window], year)[1].date() <= datetime.now().date()
+
+
+def needs_run(year, window="water_year"):
+    # Finished windows whose output was written with the current config from settled days only are
+    # skipped; the in-progress one, and any still holding provisional or unpublished days, is refreshed
+    if overwrite_existing or not window_finished(year, window):
+        return True
+    store = MetricsStore(metrics_store_path(window))
+    days = store.year_days(year)
+    if days is None or store.year_config(year) != run_config_hash():
+        return True
+    if export_year_files:
+        attrs = output_attrs(output_path(year, window))
+        if attrs is None or attrs.get("config_hash") != run_config_hash():
+            return True
+    stable, provisional = days
+    first, stop = window_span(WINDOWS[window], year)
+    n_days = (stop - first).days
+    if provisional > 0:
+        return True  # can still be upgraded to stable
+    if stable == n_days:
+        return False
+    if not settled(stop - timedelta(days=1)):
+        return True  # days PRISM answered with a 404 may still be published
+    # Days whose download failed were never recorded as missing from PRISM; retry them whatever their age
+    archive = daily_archive()
+    return archive is not None and archive.exists() and bool(np.any(archive.status(first, n_days) == STATUS_MISSING))
+
+
+def published_days(wy):
+    # Days of the water year PRISM can have published by now (a day appears the morning after)
+    today = datetime.now().date()
+    return [d for d in water_year_dates(wy) if d.date() < today]
+
+
+def days_to_refresh(wy, status):
+    # (day indices, stabilities to try) for days the archive lacks or can still upgrade to stable
+    return refresh_plan(status, published_days(wy))
+
+
+def queue_water_year(wy, fetcher):
+    # Returns (mode, checkpoint, queued days):
+    #   "archive"  every day is already settled in the daily archive; nothing to download
+    #   "refresh"  the archive has the year; only new days and provisional/early upgrades are queued
+    #   "ingest"   full ingest into a checkpoint cube, resuming after its last completed day
+    dates = water_year_dates(wy)
+    archive = daily_archive()
+    if archive is not None and archive.exists():
+        status = archive.status(dates[0], len(dates))
+        if np.any(status != STATUS_MISSING):
+            todo, tries = days_to_refresh(wy, status)
+            if not todo:
+                return "archive", None, None
+            if incremental:
+                return "refresh", None, fetcher.submit([dates[i] for i in todo], tries)
+
+    checkpoint = YearCheckpoint(checkpoint_dir, wy, ingest_config_hash(), len(dates))
+    if checkpoint.next_day:
+        print(f"Resuming WY {wy} from checkpoint at {dates[checkpoint.next_day - 1].date()}")
+    return "ingest", checkpoint, fetcher.submit(published_days(wy)[checkpoint.next_day:], STABILITY_ORDER)
+
+
+def archived_cells():
+    # The daily archive's valid-cell index, so every water year packs its cube the same way
+    archive = daily_archive()
+    return archive.cell_index() if archive is not None and archive.exists() else None
+
+
+def store_day(cells, grid, row, date):
+    # Pack a decoded (lat, lon) day into its cube row as 0.01 mm codes
+    if np.nanmax(grid) > PPT_MAX_MM:
+        print(f"Warning: {date:%Y%m%d} has ppt above {PPT_MAX_MM} mm, stored saturated")
+    encode_ppt(cells.pack(grid), out=row)
+
+
+def decode_days(wy, year_days, on_day, missing_label="Not found"):
+    # Decode queued days in date order; on_day(i, date, content, stability) stores day i of the water year
+    first_date = water_year_dates(wy)[0]
+    for current, future in PrismFetcher.iter_ordered(year_days):
+        date_str = current.strftime("%Y%m%d")
+        i = (current - first_date).days
 
-            print(f"Processed {date_str} | Time: {time.time() - t0:.2f}s")
+        try:
+            content, stability = future.result()
+            t0 = time.time()
+            on_day(i, current, content, stability)
+            if content is None:
+                print(f"{missing_label}: {date_str}")
+            else:
+                print(f"Processed {date_str} ({stability}) | Time: {time.time() - t0:.2f}s")
 
         except Exception as e:
             print(f"Error on {date_str}: {e}")
 
-        finally:
-            if os.path.exists(output_dir):
-                shutil.rmtree(output_dir)
 
-        current += timedelta(days=1)
+def ingest_water_year(wy, checkpoint, year_days):
+    # Decode the queued days in date order into the year's packed (days, cell) checkpoint cube of
+    # uint16 0.01 mm codes; row i is day i of the water year and days PRISM did not have stay
+    # PPT_FILL. Values are raw daily ppt: the wet-day threshold is applied by the metric engine,
+    # so the cube can be archived.
+    n_days = len(water_year_dates(wy))
+    state = {"cube": None, "cells": None, "grid": None, "next_day": checkpoint.next_day,
+             "status": np.full(n_days, STATUS_MISSING, dtype=np.int8)}
+    if state["next_day"]:
+        state["cube"], state["cells"], state["status"] = checkpoint.open_cube()
+
+    def on_day(i, current, content, stability):
+        if content is None:
+            state["status"][i] = STATUS_NOT_FOUND
+            return
+        if state["cube"] is None:
+            data, lat_grid, lon_grid = read_prism_day(content, variable, current, stability, region=region)
+            # PRISM's no-data mask is the same every day, so the first decoded day fixes the valid
+            # cells (unless the archive already has them)
+            state["cells"] = archived_cells() or CellIndex.from_mask(lat_grid, lon_grid, ~np.isnan(data))
+            state["cube"] = checkpoint.create_cube(state["cells"], dtype=PPT_DTYPE, fill=PPT_FILL)
+            store_day(state["cells"], data, state["cube"][i], current)
+        else:
+            if state["grid"] is None:
+                state["grid"] = np.empty(state["cells"].grid_shape, dtype=np.float32)
+            read_prism_day(content, variable, current, stability, region=region, out=state["grid"])
+            store_day(state["cells"], state["grid"], state["cube"][i], current)
+        state["status"][i] = STATUS_CODES[stability]
+        state["next_day"] = i + 1
+        if state["next_day"] % checkpoint_every == 0:
+            checkpoint.save(state["cube"], state["next_day"], state["status"])
+
+    decode_days(wy, year_days, on_day)
+
+    if state["cube"] is None:
+        return None, None, state["status"]
+    checkpoint.save(state["cube"], state["next_day"], state["status"])
+    return state["cube"], state["cells"], state["status"]
+
+
+def refresh_water_year(wy, year_days):
+    # Load the year from the daily archive, overlay only the newly fetched or upgraded days,
+    # and write just those days back. Unchanged days are neither downloaded nor decoded.
+    dates = water_year_dates(wy)
+    archive = daily_archive()
+    cells = archive.cell_index()
+    status = archive.status(dates[0], len(dates))
+    full_data = archive.read_cells(dates[0], len(dates), cells)
+    grid = np.empty(cells.grid_shape, dtype=np.float32)
+    changed = np.full(len(dates), STATUS_MISSING, dtype=np.int8)
+
+    def on_day(i, current, content, stability):
+        if content is None:
+            # An unanswered upgrade keeps the provisional/early grid we already have
+            if status[i] in (STATUS_MISSING, STATUS_NOT_FOUND):
+                changed[i] = status[i] = STATUS_NOT_FOUND
+            return
+        read_prism_day(content, variable, current, stability, region=region, out=grid)
+        store_day(cells, grid, full_data[i], current)
+        changed[i] = status[i] = STATUS_CODES[stability]
+
+    decode_days(wy, year_days, on_day, missing_label="No new version")
+    archive.write_days(dates[0], full_data, changed, cells)
+    print(f"Refreshed {np.count_nonzero(changed > 0)} days of WY {wy} in the daily archive")
+    return full_data, cells, status
+
+
+def save_metrics(year, full_data, cells, status, window="water_year"):
+    # full_data is a packed (days, cell) cube of ppt codes, decoded tile by tile as the metrics
+    # are computed; maps are scattered back to (lat, lon) for writing
+    print("Calculating metrics")
+
+    # The registry computes every intermediate the requested metrics share once per tile (one
+    # sort of the wet days feeds WD50, PRCPTOT, R95p, R95pTOT, its fraction, SDII and the WDxx
+    # family), tile by tile across tile_threads() cores sharing the one cube
+    options = dict(metrics=metric_names, wdxx_fractions=wdxx_fractions, wdxx_thresholds=wdxx_thresholds,
+                   rx_days=rx_days)
+    r95_base = r95_base_map()
+    packed = compute_metrics_tiled(full_data, workers=tile_threads(), tile=metric_tile, decode=decode_ppt,
+                                   r95_base=None if r95_base is None else cells.pack(r95_base), **options)
+    # Cells outside the index get exactly what the engine gives a cell with no data at all
+    no_data = compute_metrics(np.full((len(full_data), 1), np.nan, dtype=np.float32),
+                              r95_base=None if r95_base is None else np.full(1, np.nan, dtype=np.float32),
+                              **options)
+    metrics = {name: cells.scatter(value, fill=no_data[name][..., 0]) for name, value in packed.items()}
+
+    coords = {"lat": cells.lat, "lon": cells.lon}
+    if "wdxx" in metric_names:
+        coords["fraction"] = ("fraction", np.asarray(wdxx_fractions, dtype=np.float64), {"units": "1"})
+        coords["threshold"] = ("threshold", np.asarray(wdxx_thresholds, dtype=np.float64), {"units": "mm"})
+
+    ds = xr.Dataset(
+        {name: (METRICS[name].dims + ("lat", "lon"), metrics[name], metric_attrs(name, **options))
+         for name in metric_names},
+        coords=coords,
+        attrs={
+            "units": "mm and unitless",
+            "description": f"Precipitation metrics for {window_label(year, window)} (wet days >= {WET_DAY_THRESHOLD_MM} mm)",
+            "window": window,
+            "window_start": f"{window_span(WINDOWS[window], year)[0]:%Y-%m-%d}",
+            "window_end": f"{window_span(WINDOWS[window], year)[1] - timedelta(days=1):%Y-%m-%d}",
+            "r95_threshold": "base period {}-{}".format(*r95_base_period) if r95_base_period else "per window",
+            "region": f"lat {region['lat']}, lon {region['lon']}" if region else "CONUS",
+            "grid": output_grid or "native",
+            "config_hash": run_config_hash(),
+            "pipeline_version": PIPELINE_VERSION,
+            "stable_days": int(np.count_nonzero(status == STATUS_STABLE)),
+            "provisional_days": int(np.count_nonzero((status == STATUS_PROVISIONAL) | (status == STATUS_EARLY))),
+        }
+    )
+
+    # Coordinates become the exact canonical cell centres (grids.py), so every store and export
+    # lines up with the others by index
+    if output_grid:
+        ds = snap_dataset(ds, output_grid)
+
+    # Counts as int16 and amounts/ratios as scaled integers (see metric_registry)
+    store = MetricsStore(metrics_store_path(window))
+    store.write_year(year, ds, {name: METRICS[name].encoding for name in metric_names})
+    print(f"Saved precipitation metrics for {year} to {store.path}")
+
+    if export_year_files:
+        encoding = {}
+        for name in metric_names:
+            spatial = tuple(min(c, n) for c, n in zip(output_chunks, cells.grid_shape))
+            chunks = (1,) * len(METRICS[name].dims) + spatial
+            encoding[name] = dict(METRICS[name].encoding, zlib=True, complevel=4, chunksizes=chunks)
+        nc_path = output_path(year, window)
+        write_netcdf_atomic(ds, nc_path, encoding=encoding)
+        print(f"Exported {nc_path}")
+    return store.path
+
+
+def finish_water_year(wy, job, metrics=True):
+    # metrics=False only brings the daily archive up to date (used for the R95 base period)
+    mode, checkpoint, year_days = job
+    dates = water_year_dates(wy)
+    print(f"\nProcessing Water Year {wy} ({dates[0].date()} to {dates[-1].date()})")
+
+    if mode == "archive":
+        if not metrics:
+            return None
+        print(f"Reading WY {wy} from daily archive {daily_archive_path}")
+        archive = daily_archive()
+        cells = archive.cell_index()
+        status = archive.status(dates[0], len(dates))
+        return save_metrics(wy, archive.read_cells(dates[0], len(dates), cells), cells, status)
+
+    if mode == "refresh":
+        full_data, cells, status = refresh_water_year(wy, year_days)
+        return save_metrics(wy, full_data, cells, status) if metrics else None
+
+    full_data, cells, status = ingest_water_year(wy, checkpoint, year_days)
+    if full_data is None:
+        print(f"No valid data found for WY {wy}")
+        return None
+    if daily_archive_path:
+        daily_archive().write_days(dates[0], full_data, status, cells)
+    saved = save_metrics(wy, full_data, cells, status) if metrics else None
+    del full_data
+    # Once the days are archived, or the year is over, the scratch cube has served its purpose;
+    # otherwise keep it so the next run only ingests the new days
+    if daily_archive_path or window_finished(wy):
+        checkpoint.remove()
+    return saved
+
+
+def run_water_year(wy, metrics=True):
+    # Process-pool entry point: each worker has its own download pool and cache connection
+    fetcher, cache = make_fetcher()
+    try:
+        return finish_water_year(wy, queue_water_year(wy, fetcher), metrics)
+    finally:
+        fetcher.close()
+        cache.close()
+
+
+def run_serial(water_years, metrics=True):
+    fetcher, cache = make_fetcher()
+    try:
+        pending = queue_water_year(water_years[0], fetcher)
+        for i, wy in enumerate(water_years):
+            job = pending
+
+            # Prefetch the next water year while this one is decoded and computed
+            if i + 1 < len(water_years):
+                pending = queue_water_year(water_years[i + 1], fetcher)
+
+            finish_water_year(wy, job, metrics)
+    finally:
+        fetcher.close()
+        cache.close()
+
+
+def run_windows():
+    # Metrics for every season_windows year, sliced out of one multi-year read of the daily
+    # archive at precomputed day bounds; nothing is downloaded or decoded
+    if not season_windows or not daily_archive_path:
+        return
+    archive = daily_archive()
+    if not archive.exists():
+        print(f"No daily archive at {daily_archive_path}; skipping season windows")
+        return
+    years = range(start_water_year, end_water_year + 1)
+    jobs = [(window, year) for window in season_windows for year in years if needs_run(year, window)]
+    skipped = len(season_windows) * len(years) - len(jobs)
+    if skipped:
+        print(f"Skipping {skipped} window outputs that are already current")
+    if not jobs:
+        return
+
+    spans = [window_span(WINDOWS[window], year) for window, year in jobs]
+    first_date = min(start for start, _ in spans)
+    n_days = (max(stop for _, stop in spans) - first_date).days
+    cells = archive.cell_index()
+    status = archive.status(first_date, n_days)
+    published = (datetime.now() - first_date).days  # days from here on can't be in PRISM yet
+
+    # One read when the span fits the memory budget; otherwise each window reads its own days
+    span_bytes = PEAK_CUBE_FACTOR * n_days * cells.n_cells * np.dtype(PPT_DTYPE).itemsize
+    cube = archive.read_cells(first_date, n_days, cells) if span_bytes <= memory_budget_gb * 1024**3 else None
+
+    for window in season_windows:
+        window_years = [year for w, year in jobs if w == window]
+        for year, (lo, hi) in zip(window_years, day_bounds(WINDOWS[window], window_years, first_date)):
+            if lo >= published:
+                continue  # not started yet
+            if np.any(status[lo:min(hi, published)] == STATUS_MISSING):
+                print(f"Skipping {window_label(year, window)}: days missing from the daily archive")
+                continue
+            print(f"\nProcessing {window_label(year, window)} from daily archive")
+            days = (cube[lo:hi] if cube is not None
+                    else archive.read_cells(first_date + timedelta(days=int(lo)), hi - lo, cells))
+            save_metrics(year, days, cells, status[lo:hi], window=window)
+
+
+def set_concurrent_years(n_years):
+    # Pool initializer: record how many water years share this machine's cores
+    global concurrent_years
+    concurrent_years = n_years
+
+
+def tile_threads():
+    # Metric tile threads for this process; the parent (serial runs, windows, the R95 base map)
+    # has the machine to itself, a pool worker shares it with the other years running at once
+    if metric_threads:
+        return metric_threads
+    return max(1, (os.cpu_count() or 1) // concurrent_years)
+
+
+def parallel_workers(n_years):
+    # Limit concurrent water years so their peak memory stays inside memory_budget_gb
+    # Cubes hold land cells only; before the archive knows them, the region's bounding box bounds it
+    cells = archived_cells()
+    n_cells = cells.n_cells if cells is not None else int(np.prod(expected_shape(region)))
+    year_bytes = PEAK_CUBE_FACTOR * 366 * n_cells * np.dtype(PPT_DTYPE).itemsize
+    by_memory = int(memory_budget_gb * 1024**3 // year_bytes)
+    workers = max(1, min(water_year_workers, by_memory, n_years))
+    if workers < min(water_year_workers, n_years):
+        print(f"Memory budget of {memory_budget_gb} GB allows {workers} concurrent water years "
+              f"(~{year_bytes / 1024**3:.1f} GB each)")
+    return workers
 
-    if len(daily_stack) > 0:
-        print("Calculating metrics")
-        full_data = np.stack(daily_stack, axis=0)
 
-        full_data[full_data < 1.0] = np.nan # Filter out non-wet days (precip < 1.0 mm)
+def main():
+    os.makedirs(nc_output_dir, exist_ok=True)
+    water_years = [wy for wy in range(start_water_year, end_water_year + 1) if needs_run(wy)]
+    skipped = end_water_year - start_water_year + 1 - len(water_years)
+    if skipped:
+        print(f"Skipping {skipped} water years whose outputs are already current")
+    if r95_base_period:
+        ingest_base_period()
+        r95_base_map()  # build the base-period map once, before any worker needs it
+    if water_years:
+        run_water_years(water_years)
+    run_windows()
 
-        wd50_map = np.apply_along_axis(calculate_wd50, 0, full_data) # WD50: Number of wettest days contributing to 50% of annual precip (in paper)
 
-        prcptot_map = np.nansum(full_data, axis=0)  # PRCPTOT: Total annual precipitation from wet days (≥1.0 mm) (in paper)
+def ingest_base_period():
+    # Bring every water year touching r95_base_period into the daily archive, without metrics,
+    # so the threshold map can be built before the first output needs it
+    first, last = r95_base_period
+    if not daily_archive_path:
+        raise ValueError("r95_base_period needs daily_archive_path")
+    if r95_base_current():
+        return
+    first_date = datetime(first, 1, 1)
+    n_days = (datetime(last + 1, 1, 1) - first_date).days
+    archive = daily_archive()
+    if archive.exists() and archive.covers(first_date, n_days):
+        return
+    print(f"Ingesting water years {first}-{last + 1} into the daily archive for the R95 base period")
+    run_water_years(list(range(first, last + 2)), metrics=False)
 
-        r95_threshold = np.nanpercentile(full_data, 95, axis=0) # R95p: Number of very wet days (above 95th percentile of wet days) (not in paper)
-        r95_mask = full_data > r95_threshold
-        r95p_map = np.sum(r95_mask & ~np.isnan(full_data), axis=0)
 
-        r95ptot_map = np.sum(np.where(r95_mask, full_data, 0), axis=0) # R95pTOT: Total precipitation on very wet days (not in paper)
+def run_water_years(water_years, metrics=True):
+    workers = parallel_workers(len(water_years))
 
-        r95ptot_frac_map = np.where(prcptot_map > 0, r95ptot_map / prcptot_map, np.nan) # R95pTOT fraction: Fraction of prcptot from very wet days (in paper)
+    if workers == 1:
+        run_serial(water_years, metrics)
+        return
 
-        ds = xr.Dataset(
-            {
-                "wd50": (("lat", "lon"), wd50_map),  # Number of days summing to 50% precip
-                "prcptot": (("lat", "lon"), prcptot_map),  # Total wet-day precipitation
-                "r95p": (("lat", "lon"), r95p_map),  # Number of very wet days
-                "r95ptot": (("lat", "lon"), r95ptot_map),  # Total precip from very wet days
-                "r95ptot_frac": (("lat", "lon"), r95ptot_frac_map),  # R95pTOT / PRCPTOT
-            },
-            coords={
-                "lat": lat_grid,
-                "lon": lon_grid
-            },
-            attrs={
-                "units": "mm and unitless",
-                "description": f"Precipitation metrics (wet-day filtered) for Water Year {wy}"
-            }
-        )
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_concurrent_years, initargs=(workers,)) as pool:
+        futures = {pool.submit(run_water_year, wy, metrics): wy for wy in water_years}
+        for future in as_completed(futures):
+            wy = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error on WY {wy}: {e}")
 
-        encoding = {var: {"zlib": True, "complevel": 4} for var in ds.data_vars}
 
-        nc_path = os.path.join(nc_output_dir, f"metrics_wy{wy}.nc")
-        ds.to_netcdf(nc_path, encoding=encoding)
-        print(f"Saved precipitation metrics to {nc_path}")
+if __name__ == "__main__":
+    main()
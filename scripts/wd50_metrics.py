@@ -0,0 +1,168 @@
+"""Vectorized precipitation metric kernels over a (time, lat, lon) daily cube.
+
+The kernels work on the whole cube at once: one sort along the time axis, one
+cumulative sum, and the per-cell crossing index from a single comparison (or,
+for the WDxx family, a batched binary search of the cumulative series).
+They also accept a 1-D daily series, which is how compare_single_station.py
+uses them. metric_registry.py assembles them into the per-cube metric engine.
+
+Run this file directly to check the vectorized WD50 against the per-cell
+reference on random cubes (synthetic_cube, shared with the registry's checks
+and benchmark_metrics.py).
+"""
+import numpy as np
+
+WET_DAY_THRESHOLD_MM = 1.0
+DEFAULT_TILE = (32, 128)  # (lat, lon) cells per tile; ~6 MB of float32 per water year
+
+
+def calculate_wd50(series, wet_threshold=WET_DAY_THRESHOLD_MM):
+    # Per-cell reference: number of wettest days contributing 50% of yearly precip
+    series = series[~np.isnan(series)]
+    wet_days = series[series >= wet_threshold]
+    if len(wet_days) == 0:
+        return np.nan
+    sorted_daily = np.sort(wet_days)[::-1]
+    cumulative = np.cumsum(sorted_daily)
+    half_total = cumulative[-1] / 2
+    wd50 = np.sum(cumulative < half_total) + 1
+    return wd50
+
+
+def calculate_event_wd50(series, wet_threshold=WET_DAY_THRESHOLD_MM):
+    # Per-cell reference for storm WD50: runs of consecutive wet days are merged into events, and
+    # the result is the number of largest events contributing 50% of the wet-day total
+    events, total = [], 0.0
+    for value in series:
+        if value >= wet_threshold:  # NaN compares False, so a missing day ends an event
+            total += float(value)
+        elif total:
+            events.append(total)
+            total = 0.0
+    if total:
+        events.append(total)
+    if not events:
+        return np.nan
+    cumulative = np.cumsum(np.sort(events)[::-1])
+    return np.sum(cumulative < cumulative[-1] / 2) + 1
+
+
+def wet_event_totals(cube, wet_threshold=WET_DAY_THRESHOLD_MM):
+    # Segment sums of wet-day runs along axis 0, for every cell at once: each event's total sits on
+    # its last day and every other day is 0. One pass over the days carries a (lat, lon) running
+    # total that restarts after each non-wet day, so events are summed in the same float64 order
+    # as calculate_event_wd50 without labelling them.
+    wet = cube >= wet_threshold  # NaN compares False, so a missing day ends an event
+    ends = wet.copy()
+    ends[:-1] &= ~wet[1:]
+    totals = np.zeros(cube.shape, dtype=np.float64)
+    running = np.zeros(cube.shape[1:], dtype=np.float64)
+    for day in range(cube.shape[0]):
+        running *= wet[day]
+        np.add(running, cube[day], out=running, where=wet[day])
+        np.copyto(totals[day], running, where=ends[day])
+    return totals
+
+
+def sorted_wet_desc(cube, wet_threshold=WET_DAY_THRESHOLD_MM):
+    # Wet-day amounts sorted wettest-first along axis 0; dry, missing and NaN days become trailing zeros
+    s = np.where(cube >= wet_threshold, cube, 0).astype(cube.dtype, copy=False)
+    s.sort(axis=0)
+    return s[::-1]
+
+
+def wd50(cube, wet_threshold=WET_DAY_THRESHOLD_MM):
+    # WD50 for every cell; NaN where a cell has no wet days, same as calculate_wd50
+    if cube.shape[0] == 0:
+        return np.full(cube.shape[1:], np.nan)
+    desc = sorted_wet_desc(cube, wet_threshold)
+    cumulative = np.cumsum(desc, axis=0, out=desc)
+    total = cumulative[-1]
+    half_total = total / 2
+    counts = np.sum(cumulative < half_total, axis=0)
+    return np.where(total > 0, counts + 1, np.nan)
+
+
+def percentile_from_desc(desc, n_wet, q):
+    # Linear-interpolated percentile of each cell's wet days, matching np.nanpercentile on the
+    # wet-filtered cube (including its float32 interpolation). desc holds n_wet wet values first.
+    virtual = (n_wet - 1) * (q / 100)
+    previous = np.clip(np.floor(virtual), 0, np.maximum(n_wet - 1, 0)).astype(np.intp)
+    following = np.minimum(previous + 1, np.maximum(n_wet - 1, 0))
+    gamma = virtual - previous
+    # desc is wettest-first, so ascending rank i sits at desc[n_wet - 1 - i]
+    top = np.maximum(n_wet - 1, 0)
+    lo = np.take_along_axis(desc, (top - previous)[None], axis=0)[0]
+    hi = np.take_along_axis(desc, (top - following)[None], axis=0)[0]
+    diff = hi - lo
+    t = gamma.astype(desc.dtype)
+    result = lo + diff * t
+    upper = hi - diff * (1 - gamma).astype(desc.dtype)
+    result = np.where(gamma >= 0.5, upper, result)
+    return np.where(n_wet > 0, result, np.nan).astype(desc.dtype)
+
+
+def count_below(cumulative, targets):
+    # Per cell, the number of leading entries of the nondecreasing series cumulative (axis 0)
+    # that are < targets; equal to np.sum(cumulative < targets, axis=0) but only log2(n_days)
+    # gathers of a (lat, lon) map instead of a comparison over the whole cube.
+    lo = np.zeros(targets.shape, dtype=np.intp)
+    hi = np.full(targets.shape, cumulative.shape[0], dtype=np.intp)
+    for _ in range(int(cumulative.shape[0]).bit_length()):
+        mid = (lo + hi) // 2
+        value = np.take_along_axis(cumulative, np.minimum(mid, cumulative.shape[0] - 1)[None], axis=0)[0]
+        below = (value < targets) & (lo < hi)
+        lo = np.where(below, mid + 1, lo)
+        hi = np.where(below | (lo >= hi), hi, mid)
+    return lo
+
+
+def wdxx_from_cumulative(cumulative, n_wet, fractions):
+    # (fraction, lat, lon) WDxx maps for one wet-day threshold: the number of wettest days that
+    # contribute each fraction of PRCPTOT. The first n_wet entries of cumulative are that
+    # threshold's wet days; anything after them is >= PRCPTOT and never counted.
+    total = np.take_along_axis(cumulative, np.maximum(n_wet - 1, 0)[None], axis=0)[0]
+    total = np.where(n_wet > 0, total, 0).astype(cumulative.dtype)
+    out = np.full((len(fractions),) + total.shape, np.nan)
+    for i, fraction in enumerate(fractions):
+        counts = count_below(cumulative, total * fraction)
+        out[i] = np.where(total > 0, counts + 1, np.nan)
+    return out
+
+
+def iter_tiles(n_lat, n_lon, tile=DEFAULT_TILE):
+    for r0 in range(0, n_lat, tile[0]):
+        for c0 in range(0, n_lon, tile[1]):
+            yield slice(r0, min(r0 + tile[0], n_lat)), slice(c0, min(c0 + tile[1], n_lon))
+
+
+def iter_blocks(spatial_shape, tile=DEFAULT_TILE):
+    # Index tuples of the spatial blocks of a cube: (rows, cols) tiles of a (lat, lon) grid, or
+    # runs of tile[0] * tile[1] cells of a packed (cell,) one (see valid_cells.py)
+    if len(spatial_shape) == 2:
+        yield from iter_tiles(*spatial_shape, tile)
+        return
+    step = tile[0] * tile[1]
+    for c0 in range(0, spatial_shape[0], step):
+        yield (slice(c0, min(c0 + step, spatial_shape[0])),)
+
+
+def synthetic_cube(shape, seed=0):
+    # Random raw daily cube for self-checks and benchmarks: skewed amounts, half the days zero,
+    # scattered missing days, an all-missing row (ocean) and an all-dry row
+    rng = np.random.default_rng(seed)
+    cube = rng.gamma(0.3, 8.0, shape).astype(np.float32)
+    cube[rng.random(shape) < 0.5] = 0
+    cube[rng.random(shape) < 0.05] = np.nan
+    cube[:, 0, :] = np.nan
+    cube[:, 1, :] = 0.5
+    return cube
+
+
+if __name__ == "__main__":
+    for seed, shape in enumerate([(365, 40, 50), (366, 7, 3), (30, 20, 20)]):
+        cube = synthetic_cube(shape, seed)
+        cube[cube < WET_DAY_THRESHOLD_MM] = np.nan
+        expected = np.apply_along_axis(calculate_wd50, 0, cube)
+        assert np.array_equal(expected, wd50(cube), equal_nan=True), shape
+    print("wd50 matches per-cell calculate_wd50")
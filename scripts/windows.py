@@ -0,0 +1,58 @@
+"""Seasonal and calendar windows over a daily cube.
+
+A window is a span of the calendar that repeats every year, given by its first
+(month, day) and the (month, day) it stops before. Each window is labelled by
+the year its last day falls in, so a window that wraps past Dec 31 (the water
+year, DJF, Nov-Mar) belongs to the year it ends in. Boundaries are turned into
+day indices up front, so any number of windows can slice one multi-year cube
+(or the daily archive) without reading rasters again.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+
+Window = namedtuple("Window", "name start stop")
+
+WINDOWS = {
+    "water_year": Window("water_year", (10, 1), (10, 1)),  # Oct 1 - Sep 30
+    "calendar_year": Window("calendar_year", (1, 1), (1, 1)),
+    "djf": Window("djf", (12, 1), (3, 1)),
+    "mam": Window("mam", (3, 1), (6, 1)),
+    "jja": Window("jja", (6, 1), (9, 1)),
+    "son": Window("son", (9, 1), (12, 1)),
+    "nov_mar": Window("nov_mar", (11, 1), (4, 1)),  # cool season
+}
+
+
+def window_span(window, year):
+    # (first day, day after the last day) of the window labelled year
+    stop = datetime(year, *window.stop)
+    if (stop - timedelta(days=1)).year != year:
+        stop = datetime(year + 1, *window.stop)
+    start = datetime(stop.year, *window.start)
+    if start >= stop:
+        start = datetime(stop.year - 1, *window.start)
+    return start, stop
+
+
+def window_dates(window, year):
+    start, stop = window_span(window, year)
+    return [start + timedelta(days=i) for i in range((stop - start).days)]
+
+
+def day_bounds(window, years, first_date):
+    # (n_years, 2) array of [lo, hi) day indices of each year's window in a cube starting at first_date
+    return np.array([[(day - first_date).days for day in window_span(window, year)] for year in years],
+                    dtype=np.int64).reshape(-1, 2)
+
+
+if __name__ == "__main__":
+    assert window_dates(WINDOWS["water_year"], 2012)[0] == datetime(2011, 10, 1)
+    assert len(window_dates(WINDOWS["water_year"], 2012)) == 366
+    assert window_span(WINDOWS["calendar_year"], 2013) == (datetime(2013, 1, 1), datetime(2014, 1, 1))
+    assert len(window_dates(WINDOWS["djf"], 2012)) == 91  # Dec 2011 + leap February
+    assert window_span(WINDOWS["nov_mar"], 2013) == (datetime(2012, 11, 1), datetime(2013, 4, 1))
+    bounds = day_bounds(WINDOWS["djf"], [2012, 2013], datetime(2011, 10, 1))
+    assert bounds.tolist() == [[61, 152], [427, 517]], bounds
+    print("window spans and day bounds check out")